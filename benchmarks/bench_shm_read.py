@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Shared-memory snapshot read latency benchmark for CM PurplePill
+
+Publishes a synthetic snapshot and measures SharedSnapshotReader latency,
+on an idle region and while a writer process republishes it at a fixed
+rate, as the collector does.
+
+Usage:
+    python benchmarks/bench_shm_read.py [--gpus N] [--processes N] [--reads N] [--write-interval S]
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cmpp.shm import SharedSnapshotReader, SharedSnapshotWriter
+from cmpp.snapshot import MetricsSnapshot
+
+
+def make_snapshot(gpu_count: int, process_count: int) -> MetricsSnapshot:
+    """Build a snapshot with synthetic GPU and process data"""
+    gpus = [{
+        "index": str(i), "uuid": f"GPU-{i:08d}-0000-0000-0000-000000000000", "name": "NVIDIA A100-SXM4-80GB",
+        "memory_total": "81920", "memory_used": "1024", "memory_free": "80896", "utilization": "37",
+    } for i in range(gpu_count)]
+    processes = [{
+        "pid": 1000 + i, "gpu_uuid": gpus[i % gpu_count]["uuid"], "memory_used": "512",
+        "pod_labels": f'pod="worker-{i}",namespace="inference",stack_id="worker"',
+    } for i in range(process_count)]
+    return MetricsSnapshot([], seq=1, gpus=gpus, processes=processes)
+
+
+def publish_loop(path: str, gpu_count: int, process_count: int, interval: float, stop) -> None:
+    """Republish a synthetic snapshot every interval seconds until stop is set"""
+    writer = SharedSnapshotWriter(path)
+    snapshot = make_snapshot(gpu_count, process_count)
+    while not stop.is_set():
+        snapshot.seq += 1
+        writer.publish(snapshot)
+        time.sleep(interval)
+    writer.close()
+
+
+def measure(func, reads: int) -> list:
+    """Time each call of func in microseconds"""
+    timings = []
+    for _ in range(reads):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def report(name: str, timings: list) -> None:
+    """Print a latency summary"""
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{name:<36} median {statistics.median(timings):8.2f} us   p99 {p99:8.2f} us   max {timings[-1]:9.2f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CM PurplePill shared-memory read benchmark")
+    parser.add_argument("--gpus", type=int, default=8, help="Number of GPUs [default: 8]")
+    parser.add_argument("--processes", type=int, default=64, help="Number of processes [default: 64]")
+    parser.add_argument("--reads", type=int, default=20000, help="Reads per measurement [default: 20000]")
+    parser.add_argument("--write-interval", type=float, default=0.001,
+                        help="Seconds between publishes of the writer process [default: 0.001]")
+    args = parser.parse_args()
+
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        path = os.path.join(tmp, "cmpp-snapshot")
+        writer = SharedSnapshotWriter(path)
+        snapshot = make_snapshot(args.gpus, args.processes)
+        writer.publish(snapshot)
+        writer.close()
+
+        reader = SharedSnapshotReader(path)
+        report("free_memory, idle writer", measure(reader.free_memory, args.reads))
+        report("read, idle writer", measure(reader.read, args.reads // 10))
+
+        stop = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=publish_loop,
+            args=(path, args.gpus, args.processes, args.write_interval, stop)
+        )
+        process.start()
+        time.sleep(0.5)
+        first_seq = reader.seq()
+        report("free_memory, publishing writer", measure(reader.free_memory, args.reads))
+        report("read, publishing writer", measure(reader.read, args.reads // 10))
+        print(f"{'publishes during reads':<36} {reader.seq() - first_seq}")
+        stop.set()
+        process.join()
+
+        writer = SharedSnapshotWriter(path)
+        start = time.perf_counter()
+        for _ in range(1000):
+            writer.publish(snapshot)
+        print(f"{'publish':<36} mean   {(time.perf_counter() - start) * 1000:8.2f} us")
+
+        reader.close()
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Startup latency benchmark for CM PurplePill
+
+Measures the time to import the package, to bind the HTTP server and to
+publish the first fresh snapshot, with and without a previous metrics file
+to warm start from.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs N] [--fake-nvidia-smi]
+
+With --fake-nvidia-smi a canned nvidia-smi is put first on PATH, so the
+benchmark also runs on machines without NVIDIA GPUs.
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FAKE_NVIDIA_SMI = """#!/bin/sh
+# Answer --query-gpu with the requested fields of two canned GPUs
+gpu() {
+  out=""
+  for field in $(echo "$query" | tr ',' ' '); do
+    case "$field" in
+      index) value="$1";;
+      gpu_uuid) value="$2";;
+      name) value="NVIDIA A100-SXM4-80GB";;
+      memory.total) value="81920 MiB";;
+      memory.used) value="$3 MiB";;
+      memory.free) value="$((81920 - $3)) MiB";;
+      utilization.gpu) value="$4 %";;
+      *) value="[N/A]";;
+    esac
+    out="${out:+$out, }$value"
+  done
+  echo "$out"
+}
+for arg; do
+  case "$arg" in --query-gpu=*) query="${arg#--query-gpu=}";; esac
+done
+case "$*" in
+  *--query-gpu*)
+    gpu 0 GPU-00000000-0000-0000-0000-000000000000 1024 37
+    gpu 1 GPU-11111111-1111-1111-1111-111111111111 0 0;;
+  *--query-compute-apps*)
+    echo "1, GPU-00000000-0000-0000-0000-000000000000, 1024 MiB";;
+  *) echo "NVIDIA-SMI version  : 0.0";;
+esac
+"""
+
+
+def measure_import() -> float:
+    """Time to import the package in a fresh interpreter, net of interpreter startup"""
+    def run(code):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)) + "/..")
+        return time.perf_counter() - start
+
+    return run("import cmpp.main") - run("pass")
+
+
+def measure_start(metrics_file: str) -> dict:
+    """Time to bind the server, serve the first scrape and publish the first fresh snapshot"""
+    from cmpp.collector import MetricsCollector
+    from cmpp.server import MetricsServer
+
+    start = time.perf_counter()
+    collector = MetricsCollector(metrics_file=metrics_file, interval=3600)
+    server = MetricsServer(collector, host="127.0.0.1", port=0)
+    collector.start()
+    server.start()
+    bound = time.perf_counter()
+
+    port = server.server.server_address[1]
+    body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read()
+    first_scrape = time.perf_counter()
+
+    collector.wait_first_collection(60)
+    fresh = time.perf_counter()
+
+    server.stop()
+    collector.stop()
+
+    return {
+        "bind": bound - start,
+        "first_scrape": first_scrape - start,
+        "first_scrape_bytes": len(body),
+        "first_fresh_snapshot": fresh - start,
+    }
+
+
+def report(name: str, values: list) -> None:
+    """Print a timing summary in milliseconds"""
+    values = [v * 1000 for v in values]
+    print(f"{name:<28} median {statistics.median(values):8.2f} ms   "
+          f"min {min(values):8.2f} ms   max {max(values):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CM PurplePill startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs [default: 5]")
+    parser.add_argument("--fake-nvidia-smi", action="store_true", help="Use a canned nvidia-smi")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.fake_nvidia_smi:
+            path = os.path.join(tmp, "nvidia-smi")
+            with open(path, "w") as f:
+                f.write(FAKE_NVIDIA_SMI)
+            os.chmod(path, 0o755)
+            os.environ["PATH"] = f"{tmp}{os.pathsep}{os.environ['PATH']}"
+
+        report("import", [measure_import() for _ in range(args.runs)])
+
+        for label, warm in (("cold", False), ("warm", True)):
+            results = []
+            for run in range(args.runs):
+                metrics_file = os.path.join(tmp, f"{label}-{run}.prom")
+                if warm:
+                    # Previous run leaves the metrics file behind
+                    measure_start(metrics_file)
+                results.append(measure_start(metrics_file))
+
+            report(f"{label} bind", [r["bind"] for r in results])
+            report(f"{label} first scrape", [r["first_scrape"] for r in results])
+            report(f"{label} first fresh snapshot", [r["first_fresh_snapshot"] for r in results])
+            print(f"{label + ' first scrape size':<28} {results[-1]['first_scrape_bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Rules, webhook and Server-Sent Events check for CM PurplePill
+
+Runs the RulesEngine against synthetic snapshots and delivers its events
+to a local webhook receiver and to a /api/v1/events subscriber of a local
+MetricsServer. Checks the events produced by each rule type, webhook
+batching and the flush on stop, the bounded webhook queue, SSE delivery,
+and the dropping of slow subscribers. Exits with status 1 if a check fails.
+
+Usage:
+    python benchmarks/check_rules_events.py [--batch-interval S]
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cmpp.rules import (SUBSCRIBER_QUEUE_SIZE, WEBHOOK_MAX_BATCH, WEBHOOK_QUEUE_SIZE, EventBus, RulesEngine,
+                        WebhookSink, compile_rule)
+from cmpp.server import MetricsServer, ThreadingHTTPServer
+from cmpp.snapshot import MetricsSnapshot
+
+RULES = [
+    {"name": "gpu-memory-high", "type": "memory_used_ratio", "threshold": 0.9},
+    {"name": "gpu-idle", "type": "utilization_below", "threshold": 5},
+    {"name": "utilization-drop", "type": "utilization_drop", "delta": 50},
+    {"name": "pod-arrived", "type": "new_pod"},
+    {"name": "unattributed", "type": "unattributed_process"},
+]
+
+# (rule, state, GPU UUID) of the events expected for each snapshot of SCENARIO
+EXPECTED = [
+    [("gpu-idle", "firing", "GPU-b")],
+    [("gpu-memory-high", "firing", "GPU-a"), ("gpu-idle", "resolved", "GPU-b"),
+     ("utilization-drop", "event", "GPU-a"), ("pod-arrived", "event", "GPU-a"),
+     ("unattributed", "event", "GPU-a")],
+    [("gpu-memory-high", "resolved", "GPU-a")],
+]
+
+
+def pod(name: str) -> str:
+    """Pod labels string of a synthetic pod"""
+    return f'pod="{name}",namespace="inference",stack_id="{name}"'
+
+
+def make_snapshot(seq: int, gpus: list, processes: list) -> MetricsSnapshot:
+    """Build a snapshot from (uuid, memory used, utilization) and (pid, uuid, pod labels) tuples"""
+    return MetricsSnapshot([], seq=seq, gpus=[{
+        "index": str(index), "uuid": uuid, "name": "NVIDIA A100-SXM4-80GB", "memory_total": "81920",
+        "memory_used": str(used), "memory_free": str(81920 - used), "utilization": str(utilization),
+    } for index, (uuid, used, utilization) in enumerate(gpus)], processes=[{
+        "pid": pid, "gpu_uuid": uuid, "memory_used": "512", "pod_labels": labels,
+    } for pid, uuid, labels in processes])
+
+
+SCENARIO = [
+    make_snapshot(1, [("GPU-a", 1024, 80), ("GPU-b", 0, 0)],
+                  [(100, "GPU-a", pod("x"))]),
+    make_snapshot(2, [("GPU-a", 76000, 20), ("GPU-b", 0, 50)],
+                  [(100, "GPU-a", pod("x")), (101, "GPU-a", pod("y")), (102, "GPU-a", "")]),
+    make_snapshot(3, [("GPU-a", 1024, 20), ("GPU-b", 0, 50)],
+                  [(100, "GPU-a", pod("x"))]),
+]
+
+
+class WebhookReceiver(http.server.BaseHTTPRequestHandler):
+    """Record the batches POSTed to the local webhook"""
+
+    batches = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            self.batches.append(json.loads(body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SnapshotSource:
+    """Minimal collector interface for the MetricsServer"""
+
+    def get_current_snapshot(self) -> MetricsSnapshot:
+        return SCENARIO[-1]
+
+
+def read_events(url: str, received: list) -> None:
+    """Append the events of an SSE stream to received until the connection closes"""
+    state = None
+    try:
+        with urllib.request.urlopen(url) as response:
+            for line in response:
+                line = line.decode("utf-8").rstrip("\n")
+                if line.startswith("event: "):
+                    state = line[7:]
+                elif line.startswith("data: "):
+                    event = json.loads(line[6:])
+                    received.append((state, event))
+    except OSError:
+        pass
+
+
+def wait_until(condition, timeout: float) -> bool:
+    """Poll condition until it holds or timeout seconds passed"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class Checks:
+    """Collect check results"""
+
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name: str, ok: bool, detail: str = "") -> None:
+        if not ok:
+            self.failed += 1
+        print(f"{'PASS' if ok else 'FAIL'}  {name}" + (f": {detail}" if detail and not ok else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CM PurplePill rules, webhook and SSE check")
+    parser.add_argument("--batch-interval", type=float, default=0.3,
+                        help="Webhook batch interval in seconds [default: 0.3]")
+    args = parser.parse_args()
+    checks = Checks()
+
+    receiver = ThreadingHTTPServer(("127.0.0.1", 0), WebhookReceiver)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{receiver.server_address[1]}/hook"
+
+    bus = EventBus()
+    webhooks = WebhookSink([webhook_url], batch_interval=args.batch_interval)
+    webhooks.start()
+
+    engine = RulesEngine([compile_rule(rule) for rule in RULES], hostname="check")
+    engine.add_sink(bus.publish)
+    engine.add_sink(webhooks.publish)
+
+    server = MetricsServer(SnapshotSource(), host="127.0.0.1", port=0, events=bus)
+    if not server.start():
+        print("FAIL  cannot start the HTTP server")
+        sys.exit(1)
+    events_url = f"http://127.0.0.1:{server.server.server_address[1]}/api/v1/events"
+
+    sse_events = []
+    threading.Thread(target=read_events, args=(events_url, sse_events), daemon=True).start()
+    checks.check("SSE client subscribed", wait_until(lambda: bus.subscribers, 5))
+
+    # Rules: every rule type produces its events, within one webhook batch
+    produced = []
+    started = time.monotonic()
+    for snapshot, expected in zip(SCENARIO, EXPECTED):
+        events = engine.evaluate(snapshot)
+        produced.extend(events)
+        got = [(event["rule"], event["state"], event["uuid"]) for event in events]
+        checks.check(f"rules on snapshot {snapshot.seq}", sorted(got) == sorted(expected),
+                     f"expected {expected}, got {got}")
+
+    checks.check("webhook batch delivered", wait_until(lambda: WebhookReceiver.batches, args.batch_interval + 5))
+    latency = time.monotonic() - started
+    checks.check("webhook events in one batch", WebhookReceiver.batches == [produced],
+                 f"{[len(batch) for batch in WebhookReceiver.batches]} events per batch")
+    print(f"      webhook delivery {latency * 1000:.0f} ms after the first event, "
+          f"batch interval {args.batch_interval * 1000:.0f} ms")
+
+    checks.check("SSE events delivered", wait_until(lambda: len(sse_events) >= len(produced), 5))
+    checks.check("SSE events match", [event for _, event in sse_events] == produced
+                 and all(state == event["state"] for state, event in sse_events))
+
+    # Batches are capped at WEBHOOK_MAX_BATCH events
+    WebhookReceiver.batches.clear()
+    burst = [dict(produced[0], seq=i) for i in range(WEBHOOK_MAX_BATCH * 2 + 50)]
+    webhooks.publish(burst)
+    checks.check("burst delivered", wait_until(
+        lambda: sum(len(batch) for batch in WebhookReceiver.batches) == len(burst), args.batch_interval + 5))
+    checks.check("burst batches capped", [len(batch) for batch in WebhookReceiver.batches]
+                 == [WEBHOOK_MAX_BATCH, WEBHOOK_MAX_BATCH, 50],
+                 f"{[len(batch) for batch in WebhookReceiver.batches]} events per batch")
+
+    # Events queued before stop() are sent before it returns
+    WebhookReceiver.batches.clear()
+    webhooks.publish(produced)
+    webhooks.stop()
+    checks.check("events flushed on stop", [event for batch in WebhookReceiver.batches for event in batch] == produced)
+
+    # A full webhook queue drops its oldest events instead of growing
+    stalled = WebhookSink([webhook_url])
+    stalled.publish([dict(produced[0], seq=i) for i in range(WEBHOOK_QUEUE_SIZE + 10)])
+    checks.check("webhook queue bounded", stalled.queue.qsize() == WEBHOOK_QUEUE_SIZE)
+    checks.check("oldest webhook events dropped", stalled.queue.get_nowait()["seq"] == 10)
+
+    # A subscriber that does not read is dropped once its queue is full
+    slow_bus = EventBus()
+    slow = slow_bus.subscribe()
+    slow_bus.publish([produced[0]] * SUBSCRIBER_QUEUE_SIZE)
+    checks.check("subscriber kept at a full queue", slow_bus.is_subscribed(slow))
+    slow_bus.publish([produced[0]])
+    checks.check("slow subscriber dropped", not slow_bus.is_subscribed(slow))
+
+    server.stop()
+    receiver.shutdown()
+    receiver.server_close()
+
+    print(f"{checks.failed} checks failed" if checks.failed else "All checks passed")
+    sys.exit(1 if checks.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
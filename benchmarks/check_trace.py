@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Trace recording and replay check for CM PurplePill
+
+Records collection cycles of synthetic sources (canned nvidia-smi output,
+/proc files and a clock advancing per read) to a trace, replays the trace
+through a new collector and checks that the replay reproduces the recorded
+exposition, including the source ages. A second trace is recorded by a
+killed and a restarted collector, as in multiprocess mode, and replayed
+from both of its parts. Exits with status 1 if a check fails.
+
+Usage:
+    python benchmarks/check_trace.py [--cycles N]
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cmpp.collector import TIMING_METRICS, MetricsCollector
+from cmpp.trace import RecordingIO, ReplayIO, SourceIO, part_path
+
+AGE_METRIC = "CM_PURPLEPILL_EXPORTER_SOURCE_AGE_SECONDS"
+
+# (index, uuid, memory used in MiB, utilization) of the synthetic GPUs
+GPUS = [(0, "GPU-aaaa", 1024, 37), (1, "GPU-bbbb", 0, 0)]
+
+# (pid, uuid, memory used in MiB, pod name) of the synthetic processes
+PROCESSES = [(100, "GPU-aaaa", 512, "llm-0"), (101, "GPU-aaaa", 256, "embed-0")]
+
+GPU_FIELDS = {
+    "index": lambda gpu: str(gpu[0]),
+    "gpu_uuid": lambda gpu: gpu[1],
+    "uuid": lambda gpu: gpu[1],
+    "name": lambda gpu: "NVIDIA A100-SXM4-80GB",
+    "memory.total": lambda gpu: "81920 MiB",
+    "memory.used": lambda gpu: f"{gpu[2]} MiB",
+    "memory.free": lambda gpu: f"{81920 - gpu[2]} MiB",
+    "utilization.gpu": lambda gpu: f"{gpu[3]} %",
+}
+
+
+class SyntheticIO(SourceIO):
+    """Sources of a node with two GPUs and two pods, read with a clock advancing 0.25s per read"""
+
+    def __init__(self, now: float = 1750000000.0):
+        self.now = now
+
+    def run(self, command):
+        query = command[1]
+        if query.startswith("--query-gpu="):
+            fields = query.split("=", 1)[1].split(",")
+            return True, "".join(", ".join(GPU_FIELDS.get(field, lambda gpu: "[N/A]")(gpu)
+                                           for field in fields) + "\n" for gpu in GPUS)
+        if query.startswith("--query-compute-apps="):
+            return True, "".join(f"{pid}, {uuid}, {used} MiB\n" for pid, uuid, used, _ in PROCESSES)
+        return False, "unsupported query"
+
+    def read_proc(self, path):
+        for pid, _, _, pod in PROCESSES:
+            if path == f"/proc/{pid}/environ":
+                return f"HOSTNAME={pod}\0POD_NAMESPACE=inference\0SECRET=hunter2\0".encode("utf-8")
+        return None
+
+    def nvml_available(self):
+        return False
+
+    def time(self):
+        self.now += 0.25
+        return self.now
+
+    def watch_gpus(self, uuids):
+        return None
+
+
+class SyntheticRecordingIO(RecordingIO, SyntheticIO):
+    """Recording of the synthetic sources"""
+
+    def __init__(self, path, hostname, tiers, part, now):
+        SyntheticIO.__init__(self, now)
+        RecordingIO.__init__(self, path, hostname, tiers, part=part)
+
+
+def exposition(snapshot) -> str:
+    """Exposition of a snapshot without the measured durations, which differ between runs"""
+    names = [name for name in snapshot.families if name not in TIMING_METRICS]
+    return snapshot.filter(names=names).decode("utf-8")
+
+
+def source_ages(snapshot) -> str:
+    """Source age samples of a snapshot"""
+    return snapshot.filter(names=[AGE_METRIC]).decode("utf-8")
+
+
+class Checks:
+    """Collect check results"""
+
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name: str, ok: bool, detail: str = "") -> None:
+        if not ok:
+            self.failed += 1
+        print(f"{'PASS' if ok else 'FAIL'}  {name}" + (f": {detail}" if detail and not ok else ""))
+
+
+def record(path: str, cycles: int, part: int = 0, now: float = 1750000000.0) -> list:
+    """Record cycles of the synthetic sources to a part of a trace, returning their snapshots"""
+    collector = MetricsCollector(metrics_file=os.devnull, hostname_override="check", io=SyntheticIO())
+    collector.io = SyntheticRecordingIO(path, collector.hostname,
+                                        {tier.name: tier.interval for tier in collector.tiers}, part, now)
+    snapshots = []
+    try:
+        for cycle in range(cycles):
+            # All tiers on the first cycle, then the GPU and process tiers
+            tiers = collector.tiers if cycle == 0 else [tier for tier in collector.tiers if tier.name != "inventory"]
+            snapshots.append(collector.run_pipeline(tiers))
+    finally:
+        collector.close()
+    return snapshots
+
+
+def replay(path: str) -> list:
+    """Replay a trace, returning the snapshot of every cycle"""
+    io = ReplayIO(path)
+    collector = MetricsCollector(metrics_file=os.devnull, hostname_override=io.header["hostname"], io=io)
+    snapshots = []
+    try:
+        for names in io.cycles():
+            snapshots.append(collector.run_pipeline([collector.get_tier(name) for name in names]))
+    finally:
+        collector.close()
+    return snapshots
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CM PurplePill trace recording and replay check")
+    parser.add_argument("--cycles", type=int, default=5, help="Collection cycles to record [default: 5]")
+    args = parser.parse_args()
+    checks = Checks()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.jsonl.gz")
+
+        recorded = record(path, args.cycles)
+        replayed = replay(path)
+        checks.check("all cycles replayed", len(replayed) == len(recorded),
+                     f"recorded {len(recorded)}, replayed {len(replayed)}")
+
+        for cycle, (original, copy) in enumerate(zip(recorded, replayed)):
+            checks.check(f"cycle {cycle} snapshot timestamp", copy.timestamp == original.timestamp,
+                         f"recorded {original.timestamp}, replayed {copy.timestamp}")
+            checks.check(f"cycle {cycle} source ages", source_ages(copy) == source_ages(original),
+                         f"recorded\n{source_ages(original)}replayed\n{source_ages(copy)}")
+            checks.check(f"cycle {cycle} exposition", exposition(copy) == exposition(original))
+
+        # A restarted collector process records the next part; the first part
+        # of a new trace removes the parts left by an earlier one
+        path = os.path.join(directory, "restart.jsonl.gz")
+        with open(part_path(path, 3), "wb") as stale:
+            stale.write(b"stale")
+        first = record(path, args.cycles)
+        checks.check("stale parts removed", not os.path.exists(part_path(path, 3)))
+
+        # Killed before closing its trace: the part ends without the gzip trailer
+        with open(path, "r+b") as killed:
+            killed.truncate(os.path.getsize(path) - 8)
+        second = record(path, args.cycles, part=1, now=1750001000.0)
+
+        restarted = replay(path)
+        checks.check("both parts replayed", len(restarted) == len(first) + len(second),
+                     f"recorded {len(first)} + {len(second)}, replayed {len(restarted)}")
+        checks.check("restarted source ages", [source_ages(snapshot) for snapshot in restarted]
+                     == [source_ages(snapshot) for snapshot in first + second])
+        checks.check("restarted exposition", [exposition(snapshot) for snapshot in restarted]
+                     == [exposition(snapshot) for snapshot in first + second])
+
+        ages = [line for line in source_ages(recorded[-1]).splitlines() if not line.startswith("#")]
+        checks.check("source ages are not negative", ages and all(float(line.split()[-1]) >= 0 for line in ages),
+                     "\n".join(ages))
+
+    print(f"{checks.failed} checks failed" if checks.failed else "All checks passed")
+    sys.exit(1 if checks.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
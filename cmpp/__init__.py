@@ -36,3 +36,4 @@ __logo__ = """
 # Simplify imports for external users
 from cmpp.collector import MetricsCollector
 from cmpp.server import MetricsServer
+from cmpp.shm import SharedSnapshotReader
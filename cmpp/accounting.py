@@ -0,0 +1,166 @@
+"""
+Accounting of finished GPU processes for CM PurplePill
+
+With accounting mode enabled on the GPUs (nvidia-smi -am 1), the driver
+keeps a record of every compute process, including processes that start
+and finish between two collections. Each finished record is accounted
+once to the pod of the process: the set of finished records seen in the
+last query acts as the cursor, and only records outside of it are new.
+
+A finished process is usually gone from /proc when its record is read,
+so the pod labels are resolved while the process is still running, each
+time it is seen by the process or the accounting query, and cached until
+its final record arrives. Refreshing them on every sighting keeps a
+reused PID from inheriting the labels of the previous process.
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from cmpp.counters import POD_COUNTER_TTL
+
+
+# Pod labels of a process are kept this long after it was last seen running
+LABEL_CACHE_TTL = 3600
+
+
+class PodAccounting:
+    """Totals of the finished processes of a pod on a GPU"""
+
+    __slots__ = ("processes", "runtime", "utilization", "max_memory", "last_seen")
+
+    def __init__(self, timestamp: float):
+        self.processes = 0
+        # Seconds
+        self.runtime = 0.0
+        # Utilization integrated over the runtime, in seconds at 100%
+        self.utilization = 0.0
+        # Largest maximum memory usage of a process in MiB
+        self.max_memory = 0.0
+        self.last_seen = timestamp
+
+
+class AccountingTracker:
+    """Account finished GPU processes to their pods, each record exactly once"""
+
+    def __init__(self):
+        # Keys of the finished records of the last query, None before the first query
+        self.seen: Optional[Set[Tuple]] = None
+        # PID -> [pod labels, last seen running]
+        self.labels: Dict[int, List[Any]] = {}
+        # (GPU UUID, pod labels) -> totals
+        self.pods: Dict[Tuple[str, str], PodAccounting] = {}
+
+    def remember(self, pid: int, pod_labels: str, timestamp: float) -> None:
+        """
+        Cache the current pod labels of a running process
+
+        Args:
+            pid: Process ID
+            pod_labels: Pod labels string, empty if the process is not in a pod
+            timestamp: Time the process was seen running
+        """
+        self.labels[pid] = [pod_labels, timestamp]
+
+    def update(self,
+               timestamp: float,
+               records: List[Dict[str, Any]],
+               resolve: Callable[[int], str]) -> int:
+        """
+        Process the records of an accounting query
+
+        The finished records present at the first query only set the
+        cursor, as they may have been accounted by a previous run. Finished
+        records are accounted before the labels of running processes are
+        refreshed, as a finished process and a running one may share a
+        reused PID.
+
+        Args:
+            timestamp: Time of the query
+            records: Accounting records as returned by the collector
+            resolve: Callable returning the current pod labels string of a PID
+
+        Returns:
+            Number of newly finished records
+        """
+        finished = set()
+        finished_pids = set()
+        running_pids = set()
+        new = 0
+
+        for record in records:
+            pid = record["pid"]
+
+            if record["running"]:
+                running_pids.add(pid)
+                continue
+
+            key = (record["gpu_uuid"], pid, record["time_ms"], record["max_memory"])
+            finished.add(key)
+            if self.seen is None or key in self.seen:
+                continue
+
+            new += 1
+            finished_pids.add(pid)
+            entry = self.labels.get(pid)
+            pod_labels = entry[0] if entry is not None else resolve(pid)
+            if pod_labels:
+                self._account(timestamp, record, pod_labels)
+
+        self.seen = finished
+
+        for pid in running_pids:
+            self.labels[pid] = [resolve(pid), timestamp]
+
+        # Final records consumed the cached labels of their processes
+        for pid in finished_pids - running_pids:
+            self.labels.pop(pid, None)
+
+        expired = [pid for pid, entry in self.labels.items() if timestamp - entry[1] > LABEL_CACHE_TTL]
+        for pid in expired:
+            del self.labels[pid]
+
+        expired = [key for key, pod in self.pods.items() if timestamp - pod.last_seen > POD_COUNTER_TTL]
+        for key in expired:
+            del self.pods[key]
+
+        return new
+
+    def _account(self, timestamp: float, record: Dict[str, Any], pod_labels: str) -> None:
+        """Add a finished record to the totals of its pod"""
+        key = (record["gpu_uuid"], pod_labels)
+        pod = self.pods.get(key)
+        if pod is None:
+            pod = self.pods[key] = PodAccounting(timestamp)
+
+        runtime = record["time_ms"] / 1000
+        pod.processes += 1
+        pod.runtime += runtime
+        pod.utilization += runtime * (record["utilization"] or 0) / 100
+        pod.max_memory = max(pod.max_memory, record["max_memory"] or 0)
+        pod.last_seen = timestamp
+
+    def get_pods(self, uuid: str) -> List[Tuple[str, PodAccounting]]:
+        """
+        Get the totals of the pods on a GPU
+
+        Args:
+            uuid: GPU UUID
+
+        Returns:
+            List of (pod labels, totals)
+        """
+        return [(pod_labels, pod) for (gpu_uuid, pod_labels), pod in self.pods.items() if gpu_uuid == uuid]
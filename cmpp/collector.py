@@ -16,25 +16,98 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import concurrent.futures
 import csv
 import io
 import logging
+import os
 import socket
 import threading
 import time
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+from cmpp.accounting import AccountingTracker
+from cmpp.counters import CounterTracker
 from cmpp.pod_info import get_pod_info
-from cmpp.utils import execute_command, write_atomic, is_numeric
+from cmpp.snapshot import MetricFamily, MetricsSnapshot, get_section
+from cmpp.trace import RecordingIO, SourceIO
+from cmpp.utils import write_atomic, is_numeric, format_number
+
+
+# Default interval of the inventory tier (GPU names and total memory) in seconds
+INVENTORY_INTERVAL = 300
+
+
+# Worker threads running the sources and the pod enrichment of a cycle
+SOURCE_WORKERS = 4
+
+# Pipeline stages, timed in CM_PURPLEPILL_EXPORTER_STAGE_SECONDS
+STAGES = ("sources", "enrichment", "aggregation", "render", "sinks")
+
+# Tiers slowed down by adaptive sampling while the GPUs are idle
+ADAPTIVE_TIERS = ("gpu", "processes")
+
+# Exporter metrics with measured durations, left out of replay output
+TIMING_METRICS = ("CM_PURPLEPILL_EXPORTER_STAGE_SECONDS", "CM_PURPLEPILL_EXPORTER_SOURCE_SECONDS")
+
+
+class CollectionTier:
+    """
+    A source of the collector, collected on its own schedule
+    
+    fetch reads the source and may run concurrently with other sources, so
+    it must not modify the collector state; it returns None if the source
+    failed. pids optionally lists the processes of a fetch result that need
+    pod labels. apply folds a fetch result and the resolved pod labels into
+    the collector state.
+    """
+    
+    __slots__ = ("name", "interval", "effective_interval", "fetch", "pids", "apply", "next_run",
+                 "last_success", "duration")
+    
+    def __init__(self,
+                 name: str,
+                 interval: float,
+                 fetch: Callable[[], Any],
+                 apply: Callable[[Any, Dict[int, str]], None],
+                 pids: Optional[Callable[[Any], Iterable[int]]] = None):
+        self.name = name
+        self.interval = interval
+        # Interval in use, stretched by adaptive sampling
+        self.effective_interval = interval
+        self.fetch = fetch
+        self.apply = apply
+        self.pids = pids
+        # Monotonic time of the next run, due immediately
+        self.next_run = 0.0
+        # Wall clock time of the last successful run
+        self.last_success = None
+        # Seconds taken by the last fetch
+        self.duration = None
 
 
 class MetricsCollector:
-    """Collect GPU metrics and format them for Prometheus"""
+    """
+    Collect GPU metrics and format them for Prometheus
+    
+    Sources are collected in tiers with their own interval: cheap GPU gauges
+    and counters, the process table with its pod attribution (nvidia-smi
+    plus /proc scans), and the rarely changing GPU inventory. A single
+    thread runs each tier when it is due; tiers only update the collector
+    state, which is merged into a new snapshot after every run.
+    """
     
     def __init__(self, 
                  metrics_file: str = "/tmp/cmpp_metrics.prom",
-                 interval: int = 15,
-                 hostname_override: str = None):
+                 interval: float = 15,
+                 hostname_override: str = None,
+                 gpu_interval: Optional[float] = None,
+                 process_interval: Optional[float] = None,
+                 inventory_interval: Optional[float] = None,
+                 accounting: bool = False,
+                 accounting_interval: Optional[float] = None,
+                 adaptive_max_interval: Optional[float] = None,
+                 io: Optional[SourceIO] = None):
         """
         Initialize the metrics collector
         
@@ -42,6 +115,14 @@ class MetricsCollector:
             metrics_file: Path to write metrics in Prometheus format
             interval: Collection interval in seconds
             hostname_override: Custom hostname to use in metrics (defaults to system hostname)
+            gpu_interval: Interval of the GPU gauges and counters, defaults to interval
+            process_interval: Interval of the process attribution, defaults to interval
+            inventory_interval: Interval of the GPU inventory, defaults to INVENTORY_INTERVAL
+            accounting: Account finished processes from the GPU accounting records
+            accounting_interval: Interval of the accounting query, defaults to the process interval
+            adaptive_max_interval: Stretch the GPU and process intervals up to this many
+                seconds while the GPUs are idle, disabled if None
+            io: Access to the data sources, live by default; see cmpp.trace
         """
         self.logger = logging.getLogger("cmpp")
         self.metrics_file = metrics_file
@@ -50,7 +131,69 @@ class MetricsCollector:
         self.running = False
         self.thread = None
         self.metrics_lock = threading.Lock()
-        self.current_metrics = ""
+        self.current_snapshot = MetricsSnapshot([], hostname=self.hostname)
+        self.seq = 0
+        # Identifies the sequence of seq, which starts again in a new process
+        self.epoch = os.urandom(4).hex()
+        self.counters = CounterTracker()
+        self.metrics_file_loaded = False
+        self.util_timestamps = {}
+        self.io = io or SourceIO()
+        
+        # Collection state written by the tiers and merged into every snapshot
+        self.inventory: Dict[str, Dict[str, Any]] = {}
+        self.gpu_data: List[Dict[str, Any]] = []
+        self.processes_by_gpu: Dict[str, List[Dict[str, Any]]] = {}
+        self.pod_labels_by_pid: Dict[int, str] = {}
+        
+        if inventory_interval is None:
+            inventory_interval = INVENTORY_INTERVAL
+        if process_interval is None:
+            process_interval = interval
+        if gpu_interval is None:
+            gpu_interval = interval
+        if accounting_interval is None:
+            accounting_interval = process_interval
+        
+        # Apply order within a cycle: the inventory first, and the processes
+        # before the GPUs so counters are split by the latest pod attribution
+        self.tiers = [
+            CollectionTier("inventory", inventory_interval,
+                           self._get_gpu_inventory, self._apply_inventory),
+            CollectionTier("processes", process_interval,
+                           self._get_gpu_processes, self._apply_processes,
+                           pids=lambda processes: [process["pid"] for process in processes]),
+            CollectionTier("gpu", gpu_interval, self._fetch_gpus, self._apply_gpus),
+        ]
+        
+        # Optional accounting of finished processes, applied after the process tier
+        self.accounting = None
+        if accounting:
+            self.accounting = AccountingTracker()
+            self.tiers.insert(2, CollectionTier("accounting", accounting_interval,
+                                                self._fetch_accounting, self._apply_accounting,
+                                                pids=self._accounting_pids))
+        
+        # Sources and pod enrichment run on a small pool of worker threads,
+        # shut down by stop() and created again by start()
+        self.executor = self._create_executor()
+        
+        # Adaptive sampling: readings of the last GPU collection, and the
+        # NVML event set waking the loop (None = not created, False = unsupported)
+        self.adaptive_max_interval = adaptive_max_interval
+        self.idle_signature = None
+        self.idle = False
+        self.gpu_events = None
+        
+        # Seconds taken by each pipeline stage in the last cycle
+        self.stage_seconds: Dict[str, float] = {}
+        
+        # Callables invoked with each new snapshot from the collection thread
+        self.listeners = []
+        
+        # Set once the first collection finished, which also probes nvidia-smi
+        self.first_collection = threading.Event()
+        self.nvidia_available = None
     
     def start(self) -> bool:
         """
@@ -62,6 +205,13 @@ class MetricsCollector:
         if self.running:
             self.logger.warning("Metrics collector is already running")
             return False
+        
+        if not self.metrics_file_loaded:
+            self._load_metrics_file()
+            self.metrics_file_loaded = True
+        
+        if self.executor is None:
+            self.executor = self._create_executor()
             
         self.running = True
         self.thread = threading.Thread(
@@ -70,15 +220,55 @@ class MetricsCollector:
             name="CMPurplePillCollector"
         )
         self.thread.start()
-        self.logger.info(f"Metrics collector started with interval {self.interval}s")
+        intervals = ", ".join(f"{tier.name} {tier.interval}s" for tier in self.tiers)
+        self.logger.info(f"Metrics collector started with intervals: {intervals}")
+        if self.adaptive_max_interval:
+            self.logger.info(f"Adaptive sampling enabled, up to {self.adaptive_max_interval}s while GPUs are idle")
         return True
     
     def stop(self) -> None:
-        """Stop the metrics collection thread"""
+        """Stop the metrics collection thread; start() resumes the collection"""
         self.running = False
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=5.0)
             self.logger.info("Metrics collector stopped")
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+    
+    def close(self) -> None:
+        """Stop the collection for good and release the sources, e.g. finish a recorded trace"""
+        self.stop()
+        self.io.close()
+    
+    def _create_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        """Create the worker pool of the sources and the pod enrichment"""
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=SOURCE_WORKERS,
+            thread_name_prefix="CMPurplePillSource"
+        )
+    
+    def record(self, path: str, part: int = 0) -> None:
+        """
+        Record the results of all source accesses to a trace file
+        
+        Args:
+            path: Path of the gzip compressed trace, see cmpp.trace
+            part: Part of the trace to write, numbered by the supervisor per collector process
+        """
+        self.io = RecordingIO(path, self.hostname, {tier.name: tier.interval for tier in self.tiers}, part=part)
+    
+    def add_listener(self, listener: Callable[[MetricsSnapshot], None]) -> None:
+        """
+        Register a callable to be invoked with every new snapshot
+        
+        Listeners run in the collection thread after the snapshot was
+        published, so they should return quickly.
+        
+        Args:
+            listener: Callable taking the new MetricsSnapshot
+        """
+        self.listeners.append(listener)
     
     def get_current_metrics(self) -> str:
         """
@@ -87,151 +277,693 @@ class MetricsCollector:
         Returns:
             Current metrics in Prometheus format
         """
+        return self.get_current_snapshot().text
+    
+    def get_current_snapshot(self) -> MetricsSnapshot:
+        """
+        Get the snapshot of the last collection
+        
+        Returns:
+            Current metrics snapshot
+        """
         with self.metrics_lock:
-            return self.current_metrics
+            return self.current_snapshot
+    
+    def wait_first_collection(self, timeout: Optional[float] = None) -> Optional[bool]:
+        """
+        Wait for the first collection to finish
+        
+        Args:
+            timeout: Maximum time to wait in seconds
+            
+        Returns:
+            True if nvidia-smi answered the first collection, False if it failed,
+            None if the first collection did not finish in time
+        """
+        if not self.first_collection.wait(timeout):
+            return None
+        return self.nvidia_available
+    
+    def _load_metrics_file(self) -> None:
+        """
+        Warm start from the metrics file of the previous run
+        
+        Restores counter totals and previous readings, and serves the previous
+        metrics flagged as stale until the first collection finishes.
+        """
+        if not os.path.exists(self.metrics_file):
+            return
+        
+        try:
+            with open(self.metrics_file, 'r') as f:
+                content = f.read()
+            timestamp = os.path.getmtime(self.metrics_file)
+        except Exception as e:
+            self.logger.warning(f"Cannot read previous metrics from {self.metrics_file}: {e}")
+            return
+        
+        if self.counters.load_state(content):
+            self.logger.info(f"Restored counter state for {len(self.counters.gpus)} GPUs from {self.metrics_file}")
+        
+        families = [family for family in MetricsSnapshot.parse_families(content)
+                    if get_section(family.name) != "exporter"]
+        if not families:
+            return
+        
+        families.extend(self._format_exporter_metrics(stale=True))
+        with self.metrics_lock:
+            self.current_snapshot = MetricsSnapshot(families, timestamp=timestamp, stale=True, hostname=self.hostname)
+        self.logger.info(f"Serving stale metrics from {self.metrics_file} until the first collection finishes")
     
     def _collection_loop(self) -> None:
-        """Main metrics collection loop"""
+        """Main metrics collection loop, running the pipeline whenever tiers are due"""
         while self.running:
-            try:
-                # Collect and format metrics
-                metrics = self._collect_and_format_metrics()
-                
-                # Update the current metrics with thread safety
-                with self.metrics_lock:
-                    self.current_metrics = metrics
+            now = time.monotonic()
+            due = [tier for tier in self.tiers if tier.next_run <= now]
+            
+            if due:
+                for tier in due:
+                    tier.next_run = now + tier.effective_interval
                 
-                # Write to file
-                write_atomic(self.metrics_file, metrics)
+                try:
+                    self.publish(self.run_pipeline(due))
+                except Exception as e:
+                    self.logger.error(f"Error collecting metrics: {str(e)}")
                 
-            except Exception as e:
-                self.logger.error(f"Error collecting metrics: {str(e)}")
+                self.first_collection.set()
             
-            # Wait for next collection cycle
-            time_to_sleep = self.interval
-            while time_to_sleep > 0 and self.running:
-                time.sleep(min(1, time_to_sleep))
-                time_to_sleep -= 1
+            # Wait until the next tier is due
+            while self.running:
+                time_to_sleep = min(tier.next_run for tier in self.tiers) - time.monotonic()
+                if time_to_sleep <= 0:
+                    break
+                if self.idle and self.gpu_events:
+                    if self.io.wait_gpu_event(self.gpu_events, min(1, time_to_sleep)):
+                        self.logger.debug("GPU performance state changed, resuming the collection intervals")
+                        self._wake()
+                else:
+                    time.sleep(min(1, time_to_sleep))
+    
+    def get_tier(self, name: str) -> Optional[CollectionTier]:
+        """Get a collection tier by name"""
+        for tier in self.tiers:
+            if tier.name == name:
+                return tier
+        return None
     
-    def _collect_and_format_metrics(self) -> str:
+    def run_pipeline(self, tiers: List[CollectionTier]) -> MetricsSnapshot:
         """
-        Collect metrics from nvidia-smi and format them for Prometheus
+        Collect tiers and render a snapshot
         
+        The stages run in order: the sources of the tiers are fetched
+        concurrently, the processes they report are enriched with pod labels
+        in parallel, the results are aggregated into the collector state in
+        tier order, and the state is rendered into a snapshot.
+        
+        Args:
+            tiers: Collection tiers of this collector to collect
+            
         Returns:
-            Metrics in Prometheus format
+            Snapshot of the collector state after this cycle
+        """
+        self.io.begin_cycle([tier.name for tier in tiers])
+        try:
+            # Sources
+            started = time.perf_counter()
+            futures = [self.executor.submit(self._fetch, tier) for tier in tiers]
+            results = [(tier, future.result()) for tier, future in zip(tiers, futures)]
+            fetched = time.perf_counter()
+            
+            # Enrichment, once per process even if it is reported by several sources or GPUs
+            pids = sorted({pid for tier, result in results if tier.pids and result is not None
+                           for pid in tier.pids(result)})
+            pod_labels = dict(zip(pids, self.executor.map(self._get_pod_info, pids)))
+            enriched = time.perf_counter()
+            
+            # Aggregation
+            applied = []
+            for tier, result in results:
+                if result is None:
+                    continue
+                try:
+                    tier.apply(result, pod_labels)
+                    tier.last_success = self.io.time()
+                    applied.append(tier.name)
+                except Exception as e:
+                    self.logger.error(f"Error collecting {tier.name} metrics: {str(e)}")
+            
+            if self.adaptive_max_interval and "gpu" in applied:
+                self._adapt_intervals()
+            aggregated = time.perf_counter()
+            
+            # Render within the cycle, so a trace holds the snapshot timestamp
+            snapshot = self.render_snapshot()
+            rendered = time.perf_counter()
+        finally:
+            self.io.end_cycle()
+        
+        self.stage_seconds.update(sources=fetched - started, enrichment=enriched - fetched,
+                                  aggregation=aggregated - enriched, render=rendered - aggregated)
+        return snapshot
+    
+    def publish(self, snapshot: MetricsSnapshot) -> None:
         """
-        metrics = []
+        Hand a snapshot to the sinks: the HTTP server, the metrics file and the listeners
+        
+        Args:
+            snapshot: Snapshot returned by run_pipeline
+        """
+        started = time.perf_counter()
+        
+        # Update the current metrics with thread safety
+        with self.metrics_lock:
+            self.current_snapshot = snapshot
+        
+        # Write to file, with the counter state to survive restarts
+        write_atomic(self.metrics_file, f"{snapshot.text}{self.counters.dump_state()}\n")
+        
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                self.logger.error(f"Error in snapshot listener: {e}")
+        
+        self.stage_seconds["sinks"] = time.perf_counter() - started
+    
+    def _fetch(self, tier: CollectionTier) -> Any:
+        """Fetch the source of a tier, returning None if it failed"""
+        started = time.perf_counter()
+        try:
+            return tier.fetch()
+        except Exception as e:
+            self.logger.error(f"Error collecting {tier.name} metrics: {str(e)}")
+            return None
+        finally:
+            tier.duration = time.perf_counter() - started
+    
+    def _schedule_now(self, name: str) -> None:
+        """Make a tier due on the next iteration of the collection loop"""
+        tier = self.get_tier(name)
+        if tier is not None:
+            tier.next_run = 0.0
+    
+    def _adapt_intervals(self) -> None:
+        """
+        Stretch the adaptive tiers while the GPUs are idle, after a GPU collection
+        
+        The GPUs are idle when no GPU is utilized, no compute process is
+        running and the readings did not change since the last collection.
+        Each idle collection doubles the intervals, up to the maximum; any
+        activity restores them and collects the processes right away.
+        """
+        signature = [(gpu["uuid"], gpu["memory_used"], gpu["utilization"]) for gpu in self.gpu_data]
+        idle = (signature == self.idle_signature and not self.processes_by_gpu
+                and all(float(gpu["utilization"]) == 0 for gpu in self.gpu_data))
+        self.idle_signature = signature
+        
+        if not idle:
+            if self.idle:
+                self.logger.debug("GPU activity, resuming the collection intervals")
+                self._wake()
+            return
+        
+        if not self.idle:
+            self.idle = True
+            if self.gpu_events is None:
+                self.gpu_events = self.io.watch_gpus([gpu["uuid"] for gpu in self.gpu_data]) or False
+            if self.gpu_events:
+                # Discard the events of the activity that just ended
+                for _ in range(100):
+                    if not self.io.wait_gpu_event(self.gpu_events, 0):
+                        break
+        
+        for name in ADAPTIVE_TIERS:
+            tier = self.get_tier(name)
+            interval = min(tier.effective_interval * 2, max(self.adaptive_max_interval, tier.interval))
+            tier.next_run += interval - tier.effective_interval
+            tier.effective_interval = interval
+    
+    def _wake(self) -> None:
+        """Restore the intervals of the adaptive tiers and collect the processes on the next iteration"""
+        self.idle = False
+        for name in ADAPTIVE_TIERS:
+            tier = self.get_tier(name)
+            tier.next_run -= tier.effective_interval - tier.interval
+            tier.effective_interval = tier.interval
+        self._schedule_now("processes")
+    
+    def _get_pod_info(self, pid: int) -> str:
+        """Get the pod labels string of a process"""
+        return get_pod_info(pid, self.io.read_proc)
+    
+    def _apply_inventory(self, inventory: List[Dict[str, Any]], pod_labels: Dict[int, str]) -> None:
+        """Inventory tier: refresh the static attributes of the GPUs"""
+        self.inventory = {gpu["uuid"]: gpu for gpu in inventory}
+    
+    def _apply_processes(self, gpu_processes: List[Dict[str, Any]], pod_labels: Dict[int, str]) -> None:
+        """Process tier: refresh the GPU processes and their pod attribution"""
+        processes_by_gpu = {}
+        pod_labels_by_pid = {}
+        
+        for process in gpu_processes:
+            uuid = process["gpu_uuid"]
+            if uuid not in self.inventory:
+                continue
+            processes_by_gpu.setdefault(uuid, []).append(process)
+            pod_labels_by_pid[process["pid"]] = pod_labels.get(process["pid"], "")
+        
+        self.processes_by_gpu = processes_by_gpu
+        self.pod_labels_by_pid = pod_labels_by_pid
+        
+        # Keep the labels for the accounting record that arrives after the process exits
+        if self.accounting:
+            now = self.io.time()
+            for pid, labels in pod_labels_by_pid.items():
+                self.accounting.remember(pid, labels, now)
+    
+    def _fetch_accounting(self) -> Optional[List[Dict[str, Any]]]:
+        """Accounting tier: get the accounting records"""
+        if self.accounting.seen is None:
+            # First query: warn about GPUs that do not keep accounting records
+            for uuid, mode in (row[:2] for row in self._query_gpus(["gpu_uuid", "accounting.mode"]) or []):
+                if mode == "Disabled":
+                    self.logger.warning(f"Accounting mode is disabled on GPU {uuid}, enable it with 'nvidia-smi -am 1'")
+        
+        return self._get_accounted_apps()
+    
+    def _accounting_pids(self, records: List[Dict[str, Any]]) -> List[int]:
+        """Get the running processes of accounting records, and the finished ones without cached pod labels"""
+        return [record["pid"] for record in records
+                if record["running"] or record["pid"] not in self.accounting.labels]
+    
+    def _apply_accounting(self, records: List[Dict[str, Any]], pod_labels: Dict[int, str]) -> None:
+        """Accounting tier: account the processes that finished since the last query"""
+        def resolve(pid):
+            return pod_labels[pid] if pid in pod_labels else self._get_pod_info(pid)
+        
+        finished = self.accounting.update(self.io.time(), records, resolve)
+        if finished:
+            self.logger.debug(f"Accounted {finished} finished GPU processes")
+    
+    def _fetch_gpus(self) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Tuple], Dict[str, Tuple[Dict[int, float], int]]]]:
+        """
+        GPU tier: get memory usage, utilization and the NVML readings
+        
+        Returns:
+            Tuple of (nvidia-smi readings, NVML counter readings per GPU UUID,
+            per-process utilization and newest sample timestamp per GPU UUID),
+            or None if nvidia-smi failed
+        """
+        readings = self._get_gpu_info()
+        if readings is None:
+            return None
+        
+        counters = {}
+        utilization = {}
+        if self.io.nvml_available():
+            uuids = [reading["uuid"] for reading in readings]
+            counters = self.io.gpu_counters(uuids)
+            for uuid in uuids:
+                utilization[uuid] = self.io.process_utilization(uuid, self.util_timestamps.get(uuid, 0))
+        
+        return readings, counters, utilization
+    
+    def _apply_gpus(self, result, pod_labels: Dict[int, str]) -> None:
+        """GPU tier: refresh memory usage, utilization and the NVML counters"""
+        readings, counters, utilization = result
+        
         gpu_data = []
+        for reading in readings:
+            static = self.inventory.get(reading["uuid"])
+            if static is None:
+                # GPU appeared since the last inventory
+                self._schedule_now("inventory")
+                continue
+            gpu_data.append(dict(static, **reading))
+        self.gpu_data = gpu_data
+        
+        # Update NVML counters, split between pods by the last known attribution
+        if self.io.nvml_available():
+            uuids = [gpu["uuid"] for gpu in gpu_data]
+            processes_by_gpu = {uuid: self.processes_by_gpu[uuid] for uuid in uuids if uuid in self.processes_by_gpu}
+            pod_shares = self._get_pod_shares(processes_by_gpu, self.pod_labels_by_pid, utilization)
+            self.counters.update(self.io.time(), counters, pod_shares)
+    
+    def render_snapshot(self) -> MetricsSnapshot:
+        """
+        Merge the state of all tiers into a snapshot in Prometheus format
+        
+        Returns:
+            Indexed snapshot of the metrics in Prometheus format
+        """
+        timestamp = self.io.time()
+        gpu_data = self.gpu_data
+        families = []
+        
+        # Format GPU level metrics
+        gpu_families = [
+            ("CM_PURPLEPILL_GPU_MEMORY_TOTAL_MIB", "memory_total", "Total GPU memory in MiB."),
+            ("CM_PURPLEPILL_GPU_MEMORY_USED_TOTAL_MIB", "memory_used", "Total used GPU memory in MiB."),
+            ("CM_PURPLEPILL_GPU_MEMORY_FREE_MIB", "memory_free", "Free GPU memory in MiB."),
+            ("CM_PURPLEPILL_GPU_UTILIZATION", "utilization", "GPU utilization percentage."),
+        ]
+        
+        for name, field, description in gpu_families:
+            family = MetricFamily(name, description)
+            for gpu in gpu_data:
+                family.add(self._gpu_labels(gpu), gpu[field])
+            families.append(family)
+        
+        # Processes of the GPUs that are still present
+        gpu_by_uuid = {gpu["uuid"]: gpu for gpu in gpu_data}
+        processes_by_gpu = {uuid: processes for uuid, processes in self.processes_by_gpu.items()
+                            if uuid in gpu_by_uuid}
+        pod_labels_by_pid = self.pod_labels_by_pid
+        
+        # Aggregate processes per (GPU, pod) and format pod metrics
+        pod_memory = MetricFamily("CM_PURPLEPILL_GPU_MEMORY_USED_POD_MIB", "Pod GPU memory usage in MiB.")
+        pod_processes = MetricFamily("CM_PURPLEPILL_GPU_PROCESSES_POD", "Number of GPU processes of the pod.")
+        families.extend([pod_memory, pod_processes])
+        
+        for (uuid, pod_labels), (memory, count) in self._aggregate_pod_usage(processes_by_gpu, pod_labels_by_pid).items():
+            labels = self._pod_labels(gpu_by_uuid[uuid]["index"], uuid, pod_labels)
+            pod_memory.add(labels, format_number(memory))
+            pod_processes.add(labels, count)
+        
+        # Format NVML counters
+        if self.io.nvml_available():
+            families.extend(self._format_counter_metrics(gpu_data))
         
-        # Get GPU information
-        gpu_info = self._get_gpu_info()
+        if self.accounting:
+            families.extend(self._format_accounting_metrics(gpu_data))
         
-        # Format total memory metrics
-        metrics.append("# HELP CM_PURPLEPILL_GPU_MEMORY_TOTAL_MIB Total GPU memory in MiB.")
-        metrics.append("# TYPE CM_PURPLEPILL_GPU_MEMORY_TOTAL_MIB gauge")
+        sources = {tier.name: tier.last_success for tier in self.tiers if tier.last_success is not None}
+        families.extend(self._format_exporter_metrics(stale=False, sources=sources, timestamp=timestamp))
         
-        for gpu in gpu_info:
-            # Store for later use
-            gpu_data.append(gpu)
+        processes = [dict(process, pod_labels=pod_labels_by_pid.get(process["pid"], ""))
+                     for gpu_processes in processes_by_gpu.values() for process in gpu_processes]
+        
+        self.seq += 1
+        return MetricsSnapshot(families, timestamp=timestamp, seq=self.seq, hostname=self.hostname,
+                               gpus=gpu_data, processes=processes, sources=sources, epoch=self.epoch)
+    
+    def _format_exporter_metrics(self,
+                                 stale: bool,
+                                 sources: Optional[Dict[str, float]] = None,
+                                 timestamp: Optional[float] = None) -> List[MetricFamily]:
+        """
+        Format metrics about the exporter itself
+        
+        Args:
+            stale: True if the snapshot was restored from a previous run
+            sources: Time of the last successful collection of each source
+            timestamp: Time of the snapshot, the reference for the source ages
             
-            # Add total memory metrics
-            labels = f'gpu="{gpu["index"]}",UUID="{gpu["uuid"]}",modelName="{gpu["name"]}",Hostname="{self.hostname}"'
-            metrics.append(f'CM_PURPLEPILL_GPU_MEMORY_TOTAL_MIB{{{labels}}} {gpu["memory_total"]}')
+        Returns:
+            List of metric families
+        """
+        stale_family = MetricFamily("CM_PURPLEPILL_EXPORTER_SNAPSHOT_STALE",
+                                    "1 if the metrics were restored from the previous run and not collected yet.")
+        stale_family.add(f'Hostname="{self.hostname}"', 1 if stale else 0)
         
-        # Format used memory metrics
-        metrics.append("# HELP CM_PURPLEPILL_GPU_MEMORY_USED_TOTAL_MIB Total used GPU memory in MiB.")
-        metrics.append("# TYPE CM_PURPLEPILL_GPU_MEMORY_USED_TOTAL_MIB gauge")
+        age_family = MetricFamily("CM_PURPLEPILL_EXPORTER_SOURCE_AGE_SECONDS",
+                                  "Seconds since the source was last collected successfully.")
+        for source, collected in (sources or {}).items():
+            age_family.add(f'Hostname="{self.hostname}",source="{source}"', format_number(timestamp - collected))
         
-        for gpu in gpu_data:
-            labels = f'gpu="{gpu["index"]}",UUID="{gpu["uuid"]}",modelName="{gpu["name"]}",Hostname="{self.hostname}"'
-            metrics.append(f'CM_PURPLEPILL_GPU_MEMORY_USED_TOTAL_MIB{{{labels}}} {gpu["memory_used"]}')
+        if stale:
+            return [stale_family, age_family]
         
-        # Format free memory metrics
-        metrics.append("# HELP CM_PURPLEPILL_GPU_MEMORY_FREE_MIB Free GPU memory in MiB.")
-        metrics.append("# TYPE CM_PURPLEPILL_GPU_MEMORY_FREE_MIB gauge")
+        source_family = MetricFamily("CM_PURPLEPILL_EXPORTER_SOURCE_SECONDS",
+                                     "Seconds taken by the last collection of the source.")
+        for tier in self.tiers:
+            if tier.duration is not None:
+                source_family.add(f'Hostname="{self.hostname}",source="{tier.name}"', f"{tier.duration:.6f}")
         
-        for gpu in gpu_data:
-            labels = f'gpu="{gpu["index"]}",UUID="{gpu["uuid"]}",modelName="{gpu["name"]}",Hostname="{self.hostname}"'
-            metrics.append(f'CM_PURPLEPILL_GPU_MEMORY_FREE_MIB{{{labels}}} {gpu["memory_free"]}')
+        interval_family = MetricFamily("CM_PURPLEPILL_EXPORTER_EFFECTIVE_INTERVAL_SECONDS",
+                                       "Collection interval of the source in seconds, stretched while the GPUs are idle.")
+        for tier in self.tiers:
+            interval_family.add(f'Hostname="{self.hostname}",source="{tier.name}"', format_number(tier.effective_interval))
         
-        # Format utilization metrics
-        metrics.append("# HELP CM_PURPLEPILL_GPU_UTILIZATION GPU utilization percentage.")
-        metrics.append("# TYPE CM_PURPLEPILL_GPU_UTILIZATION gauge")
+        stage_family = MetricFamily("CM_PURPLEPILL_EXPORTER_STAGE_SECONDS",
+                                    "Seconds taken by the collection pipeline stage; render and sinks of the previous cycle.")
+        for stage in STAGES:
+            if stage in self.stage_seconds:
+                stage_family.add(f'Hostname="{self.hostname}",stage="{stage}"', f"{self.stage_seconds[stage]:.6f}")
         
-        for gpu in gpu_data:
-            labels = f'gpu="{gpu["index"]}",UUID="{gpu["uuid"]}",modelName="{gpu["name"]}",Hostname="{self.hostname}"'
-            metrics.append(f'CM_PURPLEPILL_GPU_UTILIZATION{{{labels}}} {gpu["utilization"]}')
+        return [stale_family, age_family, source_family, interval_family, stage_family]
+    
+    def _gpu_labels(self, gpu: Dict[str, Any]) -> str:
+        """Build the labels string of a GPU level sample"""
+        return f'gpu="{gpu["index"]}",UUID="{gpu["uuid"]}",modelName="{gpu["name"]}",Hostname="{self.hostname}"'
+    
+    def _pod_labels(self, gpu_idx: str, gpu_uuid: str, pod_labels: str) -> str:
+        """Build the labels string of a pod level sample"""
+        return f'gpu="{gpu_idx}",UUID="{gpu_uuid}",Hostname="{self.hostname}",device="nvidia{gpu_idx}",{pod_labels}'
+    
+    def _aggregate_pod_usage(self,
+                             processes_by_gpu: Dict[str, List[Dict[str, Any]]],
+                             pod_labels_by_pid: Dict[int, str]) -> Dict[Tuple[str, str], List[float]]:
+        """
+        Aggregate the processes of each pod on each GPU
         
-        # Get process information and format pod metrics
-        metrics.append("# HELP CM_PURPLEPILL_GPU_MEMORY_USED_POD_MIB Pod GPU memory usage in MiB.")
-        metrics.append("# TYPE CM_PURPLEPILL_GPU_MEMORY_USED_POD_MIB gauge")
+        Several processes of a pod on the same GPU (workers, forks, MPS clients)
+        share one label set, so they are summed into a single series.
+        Processes without pod information are skipped.
         
-        processes = self._get_gpu_processes()
-        for process in processes:
-            # Find GPU data for this UUID
-            gpu_idx = None
-            for gpu in gpu_data:
-                if gpu["uuid"] == process["gpu_uuid"]:
-                    gpu_idx = gpu["index"]
-                    break
+        Args:
+            processes_by_gpu: Processes grouped by GPU UUID
+            pod_labels_by_pid: Pod labels string of each process
             
-            if gpu_idx is None:
-                continue
+        Returns:
+            Dictionary mapping (GPU UUID, pod labels) to [memory used in MiB, process count]
+        """
+        usage = {}
+        
+        for uuid, gpu_processes in processes_by_gpu.items():
+            for process in gpu_processes:
+                pod_labels = pod_labels_by_pid.get(process["pid"])
+                if not pod_labels:
+                    continue
                 
-            # Get pod information
-            pod_labels = get_pod_info(process["pid"])
+                entry = usage.get((uuid, pod_labels))
+                if entry is None:
+                    entry = usage[(uuid, pod_labels)] = [0.0, 0]
+                entry[0] += float(process["memory_used"])
+                entry[1] += 1
+        
+        return usage
+    
+    def _get_pod_shares(self,
+                        processes_by_gpu: Dict[str, List[Dict[str, Any]]],
+                        pod_labels_by_pid: Dict[int, str],
+                        utilization: Dict[str, Tuple[Dict[int, float], int]]) -> Dict[str, Dict[str, float]]:
+        """
+        Compute the utilization share of each pod on each GPU since the last cycle
+        
+        Shares are based on the per-process SM utilization reported by NVML. When
+        no process was busy in the interval, memory usage is used as the weight.
+        Processes outside of pods take part in the split but are not attributed.
+        
+        Args:
+            processes_by_gpu: Processes grouped by GPU UUID
+            pod_labels_by_pid: Pod labels string of each process
+            utilization: Per-process utilization and newest sample timestamp per GPU UUID
+        
+        Returns:
+            Dictionary mapping GPU UUID to a dictionary of pod labels and share (0..1)
+        """
+        shares = {}
+        
+        for uuid, (gpu_utilization, newest) in utilization.items():
+            self.util_timestamps[uuid] = newest
+        
+        for uuid, gpu_processes in processes_by_gpu.items():
+            gpu_utilization = utilization.get(uuid, ({}, 0))[0]
+            weights = [(p["pid"], gpu_utilization.get(p["pid"], 0)) for p in gpu_processes]
+            if not sum(weight for _, weight in weights):
+                weights = [(p["pid"], float(p["memory_used"])) for p in gpu_processes]
+            
+            total = sum(weight for _, weight in weights)
+            if not total:
+                continue
             
-            if pod_labels:
-                # Add process metrics with pod information
-                device_name = f"nvidia{gpu_idx}"
-                labels = f'gpu="{gpu_idx}",UUID="{process["gpu_uuid"]}",Hostname="{self.hostname}",device="{device_name}",{pod_labels}'
-                metrics.append(f'CM_PURPLEPILL_GPU_MEMORY_USED_POD_MIB{{{labels}}} {process["memory_used"]}')
+            gpu_shares = {}
+            for pid, weight in weights:
+                pod_labels = pod_labels_by_pid.get(pid)
+                if pod_labels:
+                    gpu_shares[pod_labels] = gpu_shares.get(pod_labels, 0) + weight / total
+            shares[uuid] = gpu_shares
         
-        return "\n".join(metrics)
+        return shares
     
-    def _get_gpu_info(self) -> List[Dict[str, Any]]:
+    def _format_counter_metrics(self, gpu_data: List[Dict[str, Any]]) -> List[MetricFamily]:
         """
-        Get GPU information from nvidia-smi
+        Format the NVML counters and their rates over the last interval
         
         Returns:
-            List of dictionaries with GPU information
+            List of metric families
         """
-        success, output = execute_command([
-            "nvidia-smi", 
-            "--query-gpu=index,gpu_uuid,name,memory.total,memory.used,memory.free,utilization.gpu",
+        families = []
+        
+        counter_families = [
+            ("CM_PURPLEPILL_GPU_ENERGY_JOULES_TOTAL", "energy_mj", 0.001,
+             "Total GPU energy consumption in joules."),
+            ("CM_PURPLEPILL_GPU_PCIE_TX_BYTES_TOTAL", "pcie_tx_bytes", 1,
+             "Total bytes transmitted by the GPU over PCIe."),
+            ("CM_PURPLEPILL_GPU_PCIE_RX_BYTES_TOTAL", "pcie_rx_bytes", 1,
+             "Total bytes received by the GPU over PCIe."),
+            ("CM_PURPLEPILL_GPU_ECC_CORRECTED_ERRORS_TOTAL", "ecc_corrected", 1,
+             "Total corrected ECC errors."),
+            ("CM_PURPLEPILL_GPU_ECC_UNCORRECTED_ERRORS_TOTAL", "ecc_uncorrected", 1,
+             "Total uncorrected ECC errors."),
+        ]
+        
+        for name, field, scale, description in counter_families:
+            family = MetricFamily(name, description, "counter")
+            for gpu in gpu_data:
+                total = self.counters.get_total(gpu["uuid"], field)
+                if total is not None:
+                    family.add(self._gpu_labels(gpu), format_number(total * scale))
+            families.append(family)
+        
+        rate_families = [
+            ("CM_PURPLEPILL_GPU_POWER_AVERAGE_WATTS", "energy_mj", 0.001,
+             "Average GPU power draw in watts over the last collection interval."),
+            ("CM_PURPLEPILL_GPU_PCIE_TX_BYTES_PER_SECOND", "pcie_tx_bytes", 1,
+             "Average PCIe transmit throughput over the last collection interval."),
+            ("CM_PURPLEPILL_GPU_PCIE_RX_BYTES_PER_SECOND", "pcie_rx_bytes", 1,
+             "Average PCIe receive throughput over the last collection interval."),
+        ]
+        
+        for name, field, scale, description in rate_families:
+            family = MetricFamily(name, description)
+            for gpu in gpu_data:
+                rate = self.counters.get_rate(gpu["uuid"], field)
+                if rate is not None:
+                    family.add(self._gpu_labels(gpu), format_number(rate * scale))
+            families.append(family)
+        
+        pod_energy = MetricFamily("CM_PURPLEPILL_GPU_ENERGY_POD_JOULES_TOTAL",
+                                  "GPU energy attributed to the pod by utilization share in joules.", "counter")
+        for gpu in gpu_data:
+            for pod_labels, energy in self.counters.get_pod_energy(gpu["uuid"]):
+                pod_energy.add(self._pod_labels(gpu["index"], gpu["uuid"], pod_labels), format_number(energy * 0.001))
+        families.append(pod_energy)
+        
+        return families
+    
+    def _format_accounting_metrics(self, gpu_data: List[Dict[str, Any]]) -> List[MetricFamily]:
+        """
+        Format the totals of the finished processes of each pod
+        
+        Returns:
+            List of metric families
+        """
+        processes = MetricFamily("CM_PURPLEPILL_GPU_ACCOUNTED_PROCESSES_POD_TOTAL",
+                                 "Finished GPU processes of the pod.", "counter")
+        runtime = MetricFamily("CM_PURPLEPILL_GPU_ACCOUNTED_RUNTIME_POD_SECONDS_TOTAL",
+                               "Runtime of the finished GPU processes of the pod in seconds.", "counter")
+        utilization = MetricFamily("CM_PURPLEPILL_GPU_ACCOUNTED_UTILIZATION_POD_SECONDS_TOTAL",
+                                   "GPU utilization of the finished processes of the pod over their runtime, "
+                                   "in seconds at full utilization.", "counter")
+        max_memory = MetricFamily("CM_PURPLEPILL_GPU_ACCOUNTED_MEMORY_MAX_POD_MIB",
+                                  "Largest maximum GPU memory usage of a finished process of the pod in MiB.")
+        
+        for gpu in gpu_data:
+            for pod_labels, pod in self.accounting.get_pods(gpu["uuid"]):
+                labels = self._pod_labels(gpu["index"], gpu["uuid"], pod_labels)
+                processes.add(labels, pod.processes)
+                runtime.add(labels, format_number(pod.runtime))
+                utilization.add(labels, format_number(pod.utilization))
+                max_memory.add(labels, format_number(pod.max_memory))
+        
+        return [processes, runtime, utilization, max_memory]
+    
+    def _query_gpus(self, fields: List[str]) -> Optional[List[List[str]]]:
+        """
+        Query GPU attributes from nvidia-smi
+        
+        The first query doubles as the nvidia-smi availability probe.
+        
+        Args:
+            fields: nvidia-smi --query-gpu field names
+            
+        Returns:
+            Rows of values with units removed, in field order, or None if nvidia-smi failed
+        """
+        success, output = self.io.run([
+            "nvidia-smi",
+            f"--query-gpu={','.join(fields)}",
             "--format=csv,noheader"
         ])
         
+        if self.nvidia_available is None:
+            self.nvidia_available = success
+        
         if not success:
             self.logger.error(f"Failed to get GPU information: {output}")
-            return []
+            return None
+        
+        rows = []
+        for row in csv.reader(io.StringIO(output)):
+            if len(row) < len(fields):
+                continue
+            rows.append([value.strip().replace(' MiB', '').replace(' %', '') for value in row])
+        return rows
+    
+    def _get_gpu_inventory(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the static GPU attributes from nvidia-smi
+        
+        Returns:
+            List of dictionaries with index, uuid, name and memory_total,
+            or None if nvidia-smi failed
+        """
+        rows = self._query_gpus(["index", "gpu_uuid", "name", "memory.total"])
+        if rows is None:
+            return None
         
         gpus = []
         
-        for row in csv.reader(io.StringIO(output)):
-            if len(row) < 7:
+        for idx, uuid, name, total_mem in (row[:4] for row in rows):
+            if not is_numeric(total_mem):
+                self.logger.warning(f"Non-numeric values in GPU inventory: {[idx, uuid, name, total_mem]}")
                 continue
-                
-            # Clean up values
-            idx = row[0].strip()
-            uuid = row[1].strip()
-            name = row[2].strip()
-            total_mem = row[3].strip().replace(' MiB', '')
-            used_mem = row[4].strip().replace(' MiB', '')
-            free_mem = row[5].strip().replace(' MiB', '')
-            util = row[6].strip().replace(' %', '')
             
-            if not is_numeric(total_mem) or not is_numeric(used_mem) or \
-               not is_numeric(free_mem) or not is_numeric(util):
+            gpus.append({
+                "index": idx,
+                "uuid": uuid,
+                "name": name,
+                "memory_total": total_mem
+            })
+        
+        return gpus
+    
+    def _get_gpu_info(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the memory usage and utilization of the GPUs from nvidia-smi
+        
+        Returns:
+            List of dictionaries with index, uuid, memory_used, memory_free
+            and utilization, or None if nvidia-smi failed
+        """
+        rows = self._query_gpus(["index", "gpu_uuid", "memory.used", "memory.free", "utilization.gpu"])
+        if rows is None:
+            return None
+        
+        gpus = []
+        
+        for row in rows:
+            idx, uuid, used_mem, free_mem, util = row[:5]
+            
+            if not is_numeric(used_mem) or not is_numeric(free_mem) or not is_numeric(util):
                 self.logger.warning(f"Non-numeric values in GPU data: {row}")
                 continue
             
-            # Add GPU information
             gpus.append({
                 "index": idx,
                 "uuid": uuid,
-                "name": name,
-                "memory_total": total_mem,
                 "memory_used": used_mem,
                 "memory_free": free_mem,
                 "utilization": util
@@ -239,14 +971,65 @@ class MetricsCollector:
         
         return gpus
     
-    def _get_gpu_processes(self) -> List[Dict[str, Any]]:
+    def _get_accounted_apps(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the accounting records of running and finished processes from nvidia-smi
+        
+        Returns:
+            List of dictionaries with the record of each process on each GPU,
+            or None if nvidia-smi failed
+        """
+        success, output = self.io.run([
+            "nvidia-smi",
+            "--query-accounted-apps=gpu_uuid,pid,gpu_utilization,max_memory_usage,time,is_running",
+            "--format=csv,noheader"
+        ])
+        
+        if not success:
+            self.logger.error(f"Failed to get accounted GPU processes: {output}")
+            return None
+        
+        records = []
+        
+        for row in csv.reader(io.StringIO(output)):
+            if len(row) < 6:
+                continue
+            
+            # Clean up values
+            uuid = row[0].strip()
+            pid = row[1].strip()
+            utilization = row[2].strip().replace(' %', '')
+            memory = row[3].strip().replace(' MiB', '')
+            runtime = row[4].strip().replace(' ms', '')
+            running = row[5].strip()
+            
+            if not pid.isdigit():
+                self.logger.warning(f"Invalid accounting record: {row}")
+                continue
+            
+            if running != "1" and not runtime.isdigit():
+                self.logger.warning(f"Invalid accounting record: {row}")
+                continue
+            
+            records.append({
+                "gpu_uuid": uuid,
+                "pid": int(pid),
+                "utilization": float(utilization) if is_numeric(utilization) else None,
+                "max_memory": float(memory) if is_numeric(memory) else None,
+                "time_ms": int(runtime) if runtime.isdigit() else None,
+                "running": running == "1"
+            })
+        
+        return records
+    
+    def _get_gpu_processes(self) -> Optional[List[Dict[str, Any]]]:
         """
         Get GPU process information from nvidia-smi
         
         Returns:
-            List of dictionaries with process information
+            List of dictionaries with process information, or None if nvidia-smi failed
         """
-        success, output = execute_command([
+        success, output = self.io.run([
             "nvidia-smi",
             "--query-compute-apps=pid,gpu_uuid,used_memory",
             "--format=csv,noheader"
@@ -254,7 +1037,7 @@ class MetricsCollector:
         
         if not success:
             self.logger.error(f"Failed to get GPU processes: {output}")
-            return []
+            return None
         
         processes = []
         
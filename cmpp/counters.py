@@ -0,0 +1,197 @@
+"""
+Monotonic counter tracking for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from cmpp.nvml import COUNTER_FIELDS
+
+
+# Prefix of the comment line carrying the counter state in the metrics file.
+# Prometheus text parsers ignore comments other than HELP and TYPE.
+STATE_PREFIX = "# CMPP_COUNTER_STATE "
+
+# NVML counters are unsigned 64-bit values
+COUNTER_MODULUS = 2 ** 64
+
+# Pod energy counters are kept this long after the pod was last seen on a GPU
+POD_COUNTER_TTL = 3600
+
+
+def wrap_delta(previous: int, current: int, modulus: int = COUNTER_MODULUS) -> int:
+    """
+    Compute the increase of a raw counter between two readings
+
+    A reading lower than the previous one is treated as a wrap-around of the
+    counter, unless the implied increase exceeds half of the counter range,
+    in which case the counter was reset (e.g. driver reload) and the current
+    reading is the increase since the reset.
+
+    Args:
+        previous: Previous raw reading
+        current: Current raw reading
+        modulus: Counter range
+
+    Returns:
+        Non-negative counter increase
+    """
+    if current >= previous:
+        return current - previous
+
+    wrapped = current + modulus - previous
+    if wrapped > modulus // 2:
+        return current
+    return wrapped
+
+
+class GpuCounterState:
+    """Previous raw readings and accumulated totals of one GPU"""
+
+    __slots__ = ("timestamp", "raw", "totals", "rates")
+
+    def __init__(self, timestamp: float, raw: List[Optional[int]], totals: List[int]):
+        self.timestamp = timestamp
+        self.raw = raw
+        self.totals = totals
+        self.rates = [None] * len(COUNTER_FIELDS)
+
+
+class CounterTracker:
+    """Turn raw NVML counter readings into exported monotonic counters and rates"""
+
+    def __init__(self):
+        self.logger = logging.getLogger("cmpp")
+        self.gpus: Dict[str, GpuCounterState] = {}
+        # (GPU UUID, pod labels) -> [energy total in mJ, last seen timestamp]
+        self.pods: Dict[Tuple[str, str], List[float]] = {}
+
+    def update(self,
+               timestamp: float,
+               readings: Dict[str, Tuple[Optional[int], ...]],
+               pod_shares: Dict[str, Dict[str, float]]) -> None:
+        """
+        Fold a new set of raw readings into the counters
+
+        Args:
+            timestamp: Time of the readings
+            readings: Raw readings per GPU UUID, ordered as COUNTER_FIELDS
+            pod_shares: Utilization share (0..1) of each pod per GPU UUID in the interval
+        """
+        for uuid, raw in readings.items():
+            raw = list(raw)
+            state = self.gpus.get(uuid)
+
+            if state is None:
+                # First reading establishes the baseline
+                self.gpus[uuid] = GpuCounterState(timestamp, raw, [0] * len(raw))
+                continue
+
+            elapsed = timestamp - state.timestamp
+            for i, current in enumerate(raw):
+                previous = state.raw[i]
+                if current is None or previous is None:
+                    state.rates[i] = None
+                    continue
+
+                delta = wrap_delta(previous, current)
+                state.totals[i] += delta
+                state.rates[i] = delta / elapsed if elapsed > 0 else None
+
+                if i == 0 and delta:
+                    self._attribute_energy(uuid, delta, pod_shares.get(uuid, {}), timestamp)
+
+            state.timestamp = timestamp
+            state.raw = raw
+
+        self._expire_pods(timestamp)
+
+    def _attribute_energy(self, uuid: str, delta: int, shares: Dict[str, float], timestamp: float) -> None:
+        """Split a GPU energy increase between pods by their utilization share"""
+        for pod_labels, share in shares.items():
+            entry = self.pods.get((uuid, pod_labels))
+            if entry is None:
+                entry = self.pods[(uuid, pod_labels)] = [0.0, timestamp]
+            entry[0] += delta * share
+            entry[1] = timestamp
+
+    def _expire_pods(self, timestamp: float) -> None:
+        """Drop pod counters that have not been updated within POD_COUNTER_TTL"""
+        expired = [key for key, entry in self.pods.items() if timestamp - entry[1] > POD_COUNTER_TTL]
+        for key in expired:
+            del self.pods[key]
+
+    def get_total(self, uuid: str, field: str) -> Optional[int]:
+        """Get the accumulated total of a counter, None if the GPU does not report it"""
+        state = self.gpus.get(uuid)
+        if state is None:
+            return None
+        i = COUNTER_FIELDS.index(field)
+        if state.raw[i] is None:
+            return None
+        return state.totals[i]
+
+    def get_rate(self, uuid: str, field: str) -> Optional[float]:
+        """Get the per-second rate of a counter over the last interval"""
+        state = self.gpus.get(uuid)
+        if state is None:
+            return None
+        return state.rates[COUNTER_FIELDS.index(field)]
+
+    def get_pod_energy(self, uuid: str) -> List[Tuple[str, float]]:
+        """Get the accumulated energy in mJ of each pod attributed on a GPU"""
+        return [(pod_labels, entry[0]) for (gpu_uuid, pod_labels), entry in self.pods.items() if gpu_uuid == uuid]
+
+    def dump_state(self) -> str:
+        """
+        Serialise the counter state for the metrics file
+
+        Returns:
+            Single comment line starting with STATE_PREFIX
+        """
+        state = {
+            "gpus": {uuid: [s.timestamp, s.raw, s.totals] for uuid, s in self.gpus.items()},
+            "pods": [[uuid, labels, entry[0], entry[1]] for (uuid, labels), entry in self.pods.items()],
+        }
+        return STATE_PREFIX + json.dumps(state, separators=(",", ":"))
+
+    def load_state(self, content: str) -> bool:
+        """
+        Restore the counter state from metrics file content
+
+        Args:
+            content: Metrics file content containing a STATE_PREFIX line
+
+        Returns:
+            True if a state was restored, False otherwise
+        """
+        for line in content.splitlines():
+            if not line.startswith(STATE_PREFIX):
+                continue
+            try:
+                state = json.loads(line[len(STATE_PREFIX):])
+                for uuid, (timestamp, raw, totals) in state["gpus"].items():
+                    if len(raw) == len(COUNTER_FIELDS) and len(totals) == len(COUNTER_FIELDS):
+                        self.gpus[uuid] = GpuCounterState(timestamp, raw, totals)
+                for uuid, labels, energy, last_seen in state["pods"]:
+                    self.pods[(uuid, labels)] = [energy, last_seen]
+                return True
+            except (ValueError, KeyError, TypeError) as e:
+                self.logger.warning(f"Ignoring invalid counter state in metrics file: {e}")
+                return False
+        return False
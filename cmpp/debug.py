@@ -0,0 +1,249 @@
+"""
+On-demand profiling endpoints for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import http.server
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from typing import Dict, List, Optional
+
+from cmpp.server import ThreadingHTTPServer
+
+
+# Limits of the profile endpoint
+MAX_PROFILE_SECONDS = 60
+SAMPLE_INTERVAL = 0.005
+
+# Number of frames kept per allocation traceback and allocators reported
+HEAP_TRACEBACK_FRAMES = 10
+HEAP_TOP_ALLOCATORS = 25
+
+
+def sample_stacks(seconds: float, interval: float = SAMPLE_INTERVAL) -> str:
+    """
+    Sample the stacks of all threads except the caller
+
+    Args:
+        seconds: Sampling duration
+        interval: Time between samples
+
+    Returns:
+        Collapsed stacks ("thread;frame;frame count" per line), as consumed
+        by flamegraph.pl and speedscope
+    """
+    own_ident = threading.get_ident()
+    counts: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+        time.sleep(interval)
+
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+# Traces of the tracing machinery itself, left out of the heap reports
+HEAP_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+)
+
+
+class HeapTracker:
+    """
+    Diff the heap between /debug/heap requests
+
+    Snapshots are only taken when a report is requested, so tracing does
+    not add the cost of a heap snapshot to every collection cycle.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def start(self) -> None:
+        """Start tracing allocations"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(HEAP_TRACEBACK_FRAMES)
+
+    def report(self, limit: int = HEAP_TOP_ALLOCATORS) -> str:
+        """
+        Report the top allocators and their growth since the previous report
+
+        Args:
+            limit: Number of allocators to report
+
+        Returns:
+            Plain text report
+        """
+        # One report at a time, each becoming the baseline of the next
+        with self.lock:
+            previous = self.previous
+            self.previous = current = tracemalloc.take_snapshot()
+
+            traced, peak = tracemalloc.get_traced_memory()
+            lines = [f"Traced memory: current {traced / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB"]
+
+            current = current.filter_traces(HEAP_FILTERS)
+            if previous is None:
+                lines.append(f"Top {limit} allocators (request again for the growth since this report):")
+                stats = current.statistics("lineno")
+            else:
+                lines.append(f"Top {limit} allocators, diff since the previous report:")
+                stats = current.compare_to(previous.filter_traces(HEAP_FILTERS), "lineno")
+
+        lines.extend(str(stat) for stat in stats[:limit])
+        return "\n".join(lines) + "\n"
+
+
+class DebugHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler for the profiling endpoints"""
+
+    # These will be set by the DebugServer class
+    heap_tracker = None
+    profile_lock = threading.Lock()
+
+    def do_GET(self):
+        """Handle GET requests"""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/debug/profile':
+            self._serve_profile(query)
+        elif url.path == '/debug/heap':
+            self._send_text(self.heap_tracker.report())
+        else:
+            self.send_error(404, "Not Found")
+
+    def _serve_profile(self, query: Dict[str, List[str]]):
+        """Sample all thread stacks for ?seconds=N and return collapsed stacks"""
+        seconds = query.get('seconds', ['10'])[0]
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            self.send_error(400, "Invalid seconds parameter")
+            return
+
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            self.send_error(400, f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+            return
+
+        if not self.profile_lock.acquire(blocking=False):
+            self.send_error(409, "A profile is already running")
+            return
+
+        try:
+            stacks = sample_stacks(seconds)
+        finally:
+            self.profile_lock.release()
+
+        self._send_text(stacks)
+
+    def _send_text(self, text: str):
+        """Send a plain text response"""
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Override to use our logger instead of stderr"""
+        logger = logging.getLogger("cmpp")
+        logger.debug(f"{self.client_address[0]} - {format % args}")
+
+
+class DebugServer:
+    """HTTP server for the profiling endpoints, only started when enabled"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9532):
+        """
+        Initialize the debug server
+
+        Args:
+            host: Host to bind the server to
+            port: Port to listen on
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.host = host
+        self.port = port
+        self.heap_tracker = HeapTracker()
+        self.server = None
+        self.thread = None
+        self.running = False
+
+    def start(self) -> bool:
+        """
+        Start allocation tracing and the HTTP server in a background thread
+
+        Returns:
+            True if started successfully, False otherwise
+        """
+        if self.running:
+            self.logger.warning(f"Debug server already running on {self.host}:{self.port}")
+            return False
+
+        try:
+            DebugHandler.heap_tracker = self.heap_tracker
+            self.server = ThreadingHTTPServer((self.host, self.port), DebugHandler)
+
+            self.heap_tracker.start()
+
+            self.thread = threading.Thread(
+                target=self.server.serve_forever,
+                daemon=True,
+                name="CMPurplePillDebugServer"
+            )
+            self.thread.start()
+
+            self.running = True
+            self.logger.warning(f"Debug endpoints enabled on {self.host}:{self.port}")
+            return True
+
+        except Exception as e:
+            self.logger.error(f"Failed to start debug server: {e}")
+            return False
+
+    def stop(self) -> None:
+        """Stop the debug server"""
+        if self.running and self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.thread and self.thread.is_alive():
+                self.thread.join(timeout=5.0)
+            self.running = False
+            self.logger.info("Debug server stopped")
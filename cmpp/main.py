@@ -9,9 +9,27 @@ Usage:
 Options:
     --port PORT             Port to expose HTTP metrics server [default: 9531]
     --interval SECONDS      Interval between metric collections [default: 15]
+    --gpu-interval SECONDS  Interval of the GPU gauges and counters [default: --interval]
+    --process-interval SECONDS       Interval of the process and pod attribution [default: --interval]
+    --inventory-interval SECONDS     Interval of the GPU inventory (names, total memory) [default: 300]
+    --accounting            Account short-lived processes from the GPU accounting records
+    --accounting-interval SECONDS    Interval of the accounting query [default: --process-interval]
+    --adaptive-max-interval SECONDS  Stretch the GPU and process intervals up to this while GPUs are idle
     --log-file FILE         Log file path [default: /var/log/cm-purplepill.log]
     --metrics-file FILE     File to store metrics [default: /tmp/cmpp_metrics.prom]
     --hostname-override HOSTNAME     Override the system hostname used in metrics labels
+    --shm-file FILE         Publish snapshots into a shared-memory file, e.g. /dev/shm/cmpp-snapshot
+    --rules-file FILE       JSON file with rules evaluated on every collection
+    --webhook-url URL       Webhook receiving batches of rule events (repeatable)
+    --debug-endpoints       Enable the /debug/profile and /debug/heap endpoints
+    --debug-host HOST       Host to bind the debug endpoints to [default: 127.0.0.1]
+    --debug-port PORT       Port of the debug endpoints [default: 9532]
+    --push-url URL          Push every snapshot to a Prometheus Pushgateway
+    --record FILE           Record all source results to a gzip trace file
+    --multiprocess          Run the collection in a supervised child process
+    --collector-memory-limit MIB     Restart the collector process above this resident memory
+    --replay FILE           Run a recorded trace through the collector, print timings and exit
+    --replay-output FILE    Write the exposition of every replayed cycle to a file
     --help                  Show this help message and exit
     --version               Show version and exit
 
@@ -39,9 +57,18 @@ import time
 from typing import Any, Dict, Optional
 
 from cmpp import __version__, __logo__
-from cmpp.collector import MetricsCollector
+from cmpp.collector import STAGES, TIMING_METRICS, MetricsCollector
+from cmpp.placement import PlacementIndex
+from cmpp.push import PushSink
+from cmpp.rules import EventBus, RulesEngine, WebhookSink, load_rules
 from cmpp.server import MetricsServer
-from cmpp.utils import setup_logging, check_nvidia_tools
+from cmpp.shm import SharedSnapshotWriter
+from cmpp.supervisor import CollectorProcess
+from cmpp.trace import ReplayIO
+from cmpp.utils import setup_logging
+
+# Maximum time to wait for the first collection, which also probes nvidia-smi
+FIRST_COLLECTION_TIMEOUT = 60
 
 
 def parse_arguments():
@@ -57,10 +84,45 @@ def parse_arguments():
     )
     parser.add_argument(
         "--interval",
-        type=int,
+        type=float,
         default=15,
         help="Interval between metric collections in seconds [default: 15]"
     )
+    parser.add_argument(
+        "--gpu-interval",
+        type=float,
+        default=None,
+        help="Interval of the GPU gauges and counters in seconds [default: --interval]"
+    )
+    parser.add_argument(
+        "--process-interval",
+        type=float,
+        default=None,
+        help="Interval of the process and pod attribution in seconds [default: --interval]"
+    )
+    parser.add_argument(
+        "--inventory-interval",
+        type=float,
+        default=None,
+        help="Interval of the GPU inventory (names, total memory) in seconds [default: 300]"
+    )
+    parser.add_argument(
+        "--accounting",
+        action="store_true",
+        help="Account short-lived processes from the GPU accounting records"
+    )
+    parser.add_argument(
+        "--accounting-interval",
+        type=float,
+        default=None,
+        help="Interval of the accounting query in seconds [default: --process-interval]"
+    )
+    parser.add_argument(
+        "--adaptive-max-interval",
+        type=float,
+        default=None,
+        help="Stretch the GPU and process intervals up to this many seconds while GPUs are idle"
+    )
     parser.add_argument(
         "--log-file",
         default="/var/log/cm-purplepill.log",
@@ -76,13 +138,153 @@ def parse_arguments():
         default=None,
         help="Override the system hostname used in metrics labels"
     )
+    parser.add_argument(
+        "--shm-file",
+        default=None,
+        help="Publish snapshots into a shared-memory file, e.g. /dev/shm/cmpp-snapshot"
+    )
+    parser.add_argument(
+        "--rules-file",
+        default=None,
+        help="JSON file with rules evaluated on every collection"
+    )
+    parser.add_argument(
+        "--webhook-url",
+        action="append",
+        default=[],
+        help="Webhook receiving batches of rule events (repeatable)"
+    )
+    parser.add_argument(
+        "--debug-endpoints",
+        action="store_true",
+        help="Enable the /debug/profile and /debug/heap endpoints"
+    )
+    parser.add_argument(
+        "--debug-host",
+        default="127.0.0.1",
+        help="Host to bind the debug endpoints to [default: 127.0.0.1]"
+    )
+    parser.add_argument(
+        "--debug-port",
+        type=int,
+        default=9532,
+        help="Port of the debug endpoints [default: 9532]"
+    )
+    parser.add_argument(
+        "--push-url",
+        default=None,
+        help="Push every snapshot to a Prometheus Pushgateway"
+    )
+    parser.add_argument(
+        "--record",
+        default=None,
+        help="Record all source results to a gzip trace file"
+    )
+    parser.add_argument(
+        "--multiprocess",
+        action="store_true",
+        help="Run the collection in a supervised child process"
+    )
+    parser.add_argument(
+        "--collector-memory-limit",
+        type=int,
+        default=None,
+        help="Restart the collector process above this resident memory in MiB"
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        help="Run a recorded trace through the collector, print timings and exit"
+    )
+    parser.add_argument(
+        "--replay-output",
+        default=None,
+        help="Write the exposition of every replayed cycle to a file"
+    )
     parser.add_argument(
         "--version",
         action="version",
         version=f"CM PurplePill {__version__}"
     )
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    for name in ("interval", "gpu_interval", "process_interval", "inventory_interval",
+                 "accounting_interval", "adaptive_max_interval"):
+        value = getattr(args, name)
+        if value is not None and value <= 0:
+            parser.error(f"--{name.replace('_', '-')} must be greater than 0, got {value}")
+    return args
+
+
+def replay(trace_file: str, output_file: Optional[str] = None) -> int:
+    """
+    Run a recorded trace through the collector as fast as possible
+    
+    Every cycle of the trace runs the collection pipeline for its tiers.
+    The time spent per source and per pipeline stage is printed to stdout.
+    
+    Args:
+        trace_file: Trace written with --record
+        output_file: File receiving the exposition of every cycle, for diffing
+        
+    Returns:
+        Exit code
+    """
+    logger = logging.getLogger("cmpp")
+    
+    try:
+        io = ReplayIO(trace_file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot read trace: {e}")
+        return 1
+    
+    collector = MetricsCollector(
+        metrics_file=os.devnull,
+        hostname_override=io.header["hostname"],
+        accounting="accounting" in io.header["tiers"],
+        io=io
+    )
+    
+    output = open(output_file, 'w') if output_file else None
+    timings: Dict[str, list] = {}
+    cycles = 0
+    start = time.perf_counter()
+    
+    try:
+        for names in io.cycles():
+            tiers = [collector.get_tier(name) for name in names]
+            if None in tiers:
+                logger.warning(f"Skipping cycle of unknown tiers {names}")
+                continue
+            
+            snapshot = collector.run_pipeline(tiers)
+            
+            for tier in tiers:
+                timings.setdefault(f"source {tier.name}", []).append(tier.duration)
+            for stage in STAGES[:-1]:
+                timings.setdefault(f"stage {stage}", []).append(collector.stage_seconds[stage])
+            
+            # Measured durations differ between runs and are left out for diffing
+            if output:
+                names = [name for name in snapshot.families if name not in TIMING_METRICS]
+                output.write(f"# REPLAY cycle={cycles} tiers={','.join(tier.name for tier in tiers)}\n")
+                output.write(snapshot.filter(names=names).decode('utf-8'))
+            cycles += 1
+    finally:
+        collector.close()
+        if output:
+            output.close()
+    
+    elapsed = time.perf_counter() - start
+    parts = f" in {len(io.parts)} parts" if len(io.parts) > 1 else ""
+    print(f"Replayed {cycles} cycles of {trace_file}{parts} (recorded by CM PurplePill {io.header.get('cmpp')}) "
+          f"in {elapsed * 1000:.1f} ms")
+    for name, values in timings.items():
+        print(f"{name:<22} count {len(values):>6}   total {sum(values) * 1000:>9.2f} ms   "
+              f"mean {sum(values) / len(values) * 1000:>8.3f} ms   max {max(values) * 1000:>8.3f} ms")
+    if io.missed:
+        print(f"{io.missed} source accesses were not found in the trace")
+    return 0
 
 
 def main():
@@ -90,37 +292,127 @@ def main():
     # Parse arguments
     args = parse_arguments()
     
+    if args.replay:
+        setup_logging(None, level=logging.WARNING)
+        sys.exit(replay(args.replay, args.replay_output))
+    
     # Setup logging
     logger = setup_logging(args.log_file, level=logging.INFO)
     logger.info(f"ConfidentialMind PurplePill starting")
     
-    # Check for NVIDIA tools
-    if not check_nvidia_tools():
-        logger.error("NVIDIA tools (nvidia-smi) not found, exiting")
-        sys.exit(1)
-    
     # Create PID file for systemd management
     pid_file = "/tmp/cmpp-exporter.pid"
     with open(pid_file, 'w') as f:
         f.write(str(os.getpid()))
     
     # Initialize components
-    collector = MetricsCollector(
+    options = dict(
         metrics_file=args.metrics_file,
         interval=args.interval,
-        hostname_override=args.hostname_override
+        hostname_override=args.hostname_override,
+        gpu_interval=args.gpu_interval,
+        process_interval=args.process_interval,
+        inventory_interval=args.inventory_interval,
+        accounting=args.accounting,
+        accounting_interval=args.accounting_interval,
+        adaptive_max_interval=args.adaptive_max_interval
     )
     
+    if args.multiprocess:
+        # The collector process runs the sinks fed by its own snapshots:
+        # metrics file, trace, shared memory and Pushgateway
+        collector = CollectorProcess(
+            options,
+            sinks={"record": args.record, "shm_file": args.shm_file, "push_url": args.push_url},
+            memory_limit=args.collector_memory_limit,
+            log_file=args.log_file
+        )
+        logger.info("Running the collection in a separate process")
+    else:
+        collector = MetricsCollector(**options)
+        if args.collector_memory_limit:
+            logger.warning("--collector-memory-limit has no effect without --multiprocess")
+    
+    # Trace of all source results, for offline replay
+    if args.record and not args.multiprocess:
+        try:
+            collector.record(args.record)
+            logger.info(f"Recording source results to {args.record}")
+        except OSError as e:
+            logger.error(f"Cannot create trace file {args.record}: {e}")
+            sys.exit(1)
+    
+    # Placement index, updated incrementally with every snapshot
+    placement = PlacementIndex()
+    collector.add_listener(placement.update)
+    
+    # Rules engine, publishing its events to SSE subscribers and webhooks
+    event_bus = None
+    webhooks = None
+    if args.rules_file:
+        try:
+            rules = load_rules(args.rules_file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load rules: {e}")
+            sys.exit(1)
+        
+        rules_engine = RulesEngine(rules, hostname=collector.hostname)
+        event_bus = EventBus()
+        rules_engine.add_sink(event_bus.publish)
+        if args.webhook_url:
+            webhooks = WebhookSink(args.webhook_url)
+            rules_engine.add_sink(webhooks.publish)
+            webhooks.start()
+        collector.add_listener(rules_engine.evaluate)
+        logger.info(f"Loaded {len(rules)} rules from {args.rules_file}")
+    elif args.webhook_url:
+        logger.warning("--webhook-url has no effect without --rules-file")
+    
     server = MetricsServer(
         collector=collector,
-        port=args.port
+        port=args.port,
+        placement=placement,
+        events=event_bus
     )
     
+    # Shared-memory snapshot for node-local consumers
+    if args.shm_file and not args.multiprocess:
+        try:
+            shm_writer = SharedSnapshotWriter(args.shm_file)
+            collector.add_listener(shm_writer.publish)
+            logger.info(f"Publishing snapshots to shared memory file {args.shm_file}")
+        except OSError as e:
+            logger.error(f"Cannot create shared memory file {args.shm_file}: {e}")
+            sys.exit(1)
+    
+    # Pushgateway sink, pushing every snapshot from its own thread
+    push = None
+    if args.push_url and not args.multiprocess:
+        push = PushSink(args.push_url, hostname=collector.hostname)
+        collector.add_listener(push.publish)
+        push.start()
+        logger.info(f"Pushing snapshots to {push.url}")
+    
+    # Profiling endpoints are only loaded when enabled
+    debug_server = None
+    if args.debug_endpoints:
+        from cmpp.debug import DebugServer
+        debug_server = DebugServer(
+            host=args.debug_host,
+            port=args.debug_port
+        )
+    
     # Setup signal handling for graceful shutdown
     def signal_handler(sig, frame):
         logger.info("Shutdown signal received, stopping...")
+        if debug_server:
+            debug_server.stop()
         server.stop()
-        collector.stop()
+        collector.close()
+        if webhooks:
+            webhooks.stop()
+        if push:
+            push.stop()
         try:
             os.unlink(pid_file)
         except:
@@ -132,7 +424,8 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     
     try:
-        # Start collector
+        # Start collector; it serves the previous metrics as stale and runs
+        # the first collection while the HTTP server binds
         if not collector.start():
             logger.error("Failed to start metrics collector")
             sys.exit(1)
@@ -140,10 +433,27 @@ def main():
         # Start HTTP server
         if not server.start():
             logger.error("Failed to start HTTP server")
-            collector.stop()
+            collector.close()
             sys.exit(1)
         
-    
+        # Start debug server; failing to start it is not fatal
+        if debug_server:
+            debug_server.start()
+        
+        # The first collection replaces the startup check for NVIDIA tools
+        nvidia_available = collector.wait_first_collection(FIRST_COLLECTION_TIMEOUT)
+        if nvidia_available is False:
+            logger.error("NVIDIA tools (nvidia-smi) not found, exiting")
+            server.stop()
+            collector.close()
+            try:
+                os.unlink(pid_file)
+            except:
+                pass
+            sys.exit(1)
+        elif nvidia_available is None:
+            logger.warning(f"First collection did not finish within {FIRST_COLLECTION_TIMEOUT}s")
+        
         # Display logo to console
         print(f"\n{__logo__}", file=sys.stderr)
         
@@ -166,7 +476,7 @@ def main():
     except Exception as e:
         logger.error(f"Error in main loop: {e}")
         server.stop()
-        collector.stop()
+        collector.close()
         try:
             os.unlink(pid_file)
         except:
@@ -0,0 +1,237 @@
+"""
+Optional NVML access for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+
+logger = logging.getLogger("cmpp")
+
+# Raw counter readings returned by get_gpu_counters, in a fixed order
+COUNTER_FIELDS = ("energy_mj", "pcie_tx_bytes", "pcie_rx_bytes", "ecc_corrected", "ecc_uncorrected")
+
+_init_lock = threading.Lock()
+_init_state = None  # None = not tried yet, True = initialised, False = unavailable
+_handles = {}
+
+
+def nvml_available() -> bool:
+    """
+    Initialise NVML on first use
+
+    Returns:
+        True if the NVML bindings (nvidia-ml-py) are installed and NVML initialised
+    """
+    global _init_state
+
+    if _init_state is not None:
+        return _init_state
+
+    with _init_lock:
+        if _init_state is None:
+            if pynvml is None:
+                logger.info("NVML bindings not installed, NVML-based metrics disabled")
+                _init_state = False
+            else:
+                try:
+                    pynvml.nvmlInit()
+                    _init_state = True
+                except Exception as e:
+                    logger.warning(f"Failed to initialise NVML, NVML-based metrics disabled: {e}")
+                    _init_state = False
+
+    return _init_state
+
+
+def _get_handle(uuid: str):
+    """Get (and cache) the NVML device handle for a GPU UUID"""
+    handle = _handles.get(uuid)
+    if handle is None:
+        handle = pynvml.nvmlDeviceGetHandleByUUID(uuid)
+        _handles[uuid] = handle
+    return handle
+
+
+def _call(func, *args) -> Optional[int]:
+    """Call an NVML getter, returning None if it is not supported by the device"""
+    try:
+        return int(func(*args))
+    except Exception:
+        return None
+
+
+def _get_field_values(handle, field_names: Tuple[str, ...]) -> List[Optional[int]]:
+    """Read NVML field values by constant name, None for fields unknown to the bindings or device"""
+    field_ids = [getattr(pynvml, name, None) for name in field_names]
+    values = [None] * len(field_names)
+
+    known = [field_id for field_id in field_ids if field_id is not None]
+    if not known:
+        return values
+
+    try:
+        results = pynvml.nvmlDeviceGetFieldValues(handle, known)
+    except Exception:
+        return values
+
+    results = iter(results)
+    for i, field_id in enumerate(field_ids):
+        if field_id is None:
+            continue
+        result = next(results)
+        if result.nvmlReturn == 0:
+            values[i] = int(result.value.ullVal)
+
+    return values
+
+
+def get_gpu_counters(uuids: List[str]) -> Dict[str, Tuple[Optional[int], ...]]:
+    """
+    Read the monotonic hardware counters of the given GPUs
+
+    Args:
+        uuids: GPU UUIDs as reported by nvidia-smi
+
+    Returns:
+        Dictionary mapping GPU UUID to raw readings ordered as COUNTER_FIELDS,
+        with None for counters the device does not support
+    """
+    counters = {}
+
+    if not nvml_available():
+        return counters
+
+    for uuid in uuids:
+        try:
+            handle = _get_handle(uuid)
+        except Exception as e:
+            logger.debug(f"NVML handle lookup failed for {uuid}: {e}")
+            continue
+
+        energy = _call(pynvml.nvmlDeviceGetTotalEnergyConsumption, handle)
+        pcie_tx, pcie_rx = _get_field_values(
+            handle, ("NVML_FI_DEV_PCIE_COUNT_TX_BYTES", "NVML_FI_DEV_PCIE_COUNT_RX_BYTES")
+        )
+        ecc_corrected = _call(pynvml.nvmlDeviceGetTotalEccErrors, handle,
+                              pynvml.NVML_MEMORY_ERROR_TYPE_CORRECTED, pynvml.NVML_AGGREGATE_ECC)
+        ecc_uncorrected = _call(pynvml.nvmlDeviceGetTotalEccErrors, handle,
+                                pynvml.NVML_MEMORY_ERROR_TYPE_UNCORRECTED, pynvml.NVML_AGGREGATE_ECC)
+
+        counters[uuid] = (energy, pcie_tx, pcie_rx, ecc_corrected, ecc_uncorrected)
+
+    return counters
+
+
+def get_process_utilization(uuid: str, since: int) -> Tuple[Dict[int, float], int]:
+    """
+    Get the average SM utilization of each process on a GPU since a timestamp
+
+    Args:
+        uuid: GPU UUID
+        since: NVML sample timestamp (microseconds) of the previous call, 0 for all buffered samples
+
+    Returns:
+        Tuple of (dictionary mapping PID to average SM utilization, newest sample timestamp)
+    """
+    if not nvml_available():
+        return {}, since
+
+    try:
+        samples = pynvml.nvmlDeviceGetProcessUtilization(_get_handle(uuid), since)
+    except Exception:
+        # NVML_ERROR_NOT_FOUND is returned when no samples were taken since the timestamp
+        return {}, since
+
+    sums = {}
+    counts = {}
+    newest = since
+
+    for sample in samples:
+        sums[sample.pid] = sums.get(sample.pid, 0) + sample.smUtil
+        counts[sample.pid] = counts.get(sample.pid, 0) + 1
+        newest = max(newest, sample.timeStamp)
+
+    return {pid: sums[pid] / counts[pid] for pid in sums}, newest
+
+
+def create_event_set(uuids: List[str]):
+    """
+    Create an NVML event set receiving the performance state changes of GPUs
+
+    A GPU leaves its idle performance state as soon as work is submitted, so
+    the event set can wake a collector that slowed down on idle GPUs.
+
+    Args:
+        uuids: GPU UUIDs as reported by nvidia-smi
+
+    Returns:
+        Event set for wait_event, or None if no GPU supports the events
+    """
+    event_type = getattr(pynvml, "nvmlEventTypePState", None)
+    if not nvml_available() or event_type is None:
+        return None
+
+    try:
+        event_set = pynvml.nvmlEventSetCreate()
+    except Exception as e:
+        logger.debug(f"NVML event set creation failed: {e}")
+        return None
+
+    registered = 0
+    for uuid in uuids:
+        try:
+            handle = _get_handle(uuid)
+            if pynvml.nvmlDeviceGetSupportedEventTypes(handle) & event_type:
+                pynvml.nvmlDeviceRegisterEvents(handle, event_type, event_set)
+                registered += 1
+        except Exception as e:
+            logger.debug(f"NVML event registration failed for {uuid}: {e}")
+
+    if not registered:
+        try:
+            pynvml.nvmlEventSetFree(event_set)
+        except Exception:
+            pass
+        return None
+
+    return event_set
+
+
+def wait_event(event_set, timeout: float) -> bool:
+    """
+    Wait for an event of an event set created by create_event_set
+
+    Args:
+        event_set: NVML event set
+        timeout: Maximum time to wait in seconds
+
+    Returns:
+        True if an event arrived, False on timeout
+    """
+    try:
+        pynvml.nvmlEventSetWait(event_set, int(timeout * 1000))
+        return True
+    except Exception:
+        # NVML_ERROR_TIMEOUT
+        return False
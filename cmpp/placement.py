@@ -0,0 +1,173 @@
+"""
+GPU placement advisory index for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bisect
+import collections
+import itertools
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from cmpp.utils import to_number
+
+
+# Seconds over which the peak memory usage is tracked
+PEAK_WINDOW = 300
+
+# Headroom is ranked in buckets of this many MiB; within a bucket, GPUs with
+# fewer co-resident pods come first
+HEADROOM_BUCKET_MIB = 4096
+
+
+class _GpuEntry:
+    """Placement state of one GPU"""
+
+    __slots__ = ("index", "uuid", "total", "free", "peak_used", "pods", "key", "window")
+
+    def __init__(self, index: str, uuid: str):
+        self.index = index
+        self.uuid = uuid
+        self.total = 0
+        self.free = 0
+        self.peak_used = 0
+        self.pods = 0
+        self.key = None
+        # (timestamp, used) pairs with decreasing usage; the front is the peak of the window
+        self.window = collections.deque()
+
+    def push_used(self, timestamp: float, used: int, window: float) -> None:
+        """Add a usage reading and update the peak of the sliding window"""
+        while self.window and self.window[-1][1] <= used:
+            self.window.pop()
+        self.window.append((timestamp, used))
+        while self.window[0][0] <= timestamp - window:
+            self.window.popleft()
+        self.peak_used = self.window[0][1]
+
+    @property
+    def headroom(self) -> int:
+        """Memory a new job can count on: free memory, reduced by recent peaks"""
+        return max(0, min(self.free, self.total - self.peak_used))
+
+
+class PlacementIndex:
+    """
+    GPUs ordered by available memory, maintained incrementally per cycle
+
+    Each GPU is keyed by (headroom bucket, co-resident pods, headroom, UUID)
+    in a sorted list, where headroom is the free memory reduced by the peak
+    usage of the last PEAK_WINDOW seconds. A cycle only moves the keys that
+    changed, and a query is a binary search for the bucket of the required
+    memory: the candidates that follow are ranked best fit first, with
+    fewer co-resident pods first among GPUs of similar headroom.
+    """
+
+    def __init__(self, window: float = PEAK_WINDOW, bucket: int = HEADROOM_BUCKET_MIB):
+        """
+        Initialize an empty index
+
+        Args:
+            window: Seconds over which peak usage is tracked
+            bucket: Size of the headroom buckets in MiB
+        """
+        self.window = window
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.entries: Dict[str, _GpuEntry] = {}
+        self.keys: List[Tuple[int, int, int, str]] = []
+        self.seq = 0
+
+    def update(self, snapshot) -> None:
+        """
+        Fold a new snapshot into the index
+
+        Args:
+            snapshot: MetricsSnapshot with GPU and process data
+        """
+        pods: Dict[str, set] = {}
+        for process in snapshot.processes:
+            if process.get("pod_labels"):
+                pods.setdefault(process["gpu_uuid"], set()).add(process["pod_labels"])
+
+        with self.lock:
+            self.seq = snapshot.seq
+            seen = set()
+
+            for gpu in snapshot.gpus:
+                uuid = gpu["uuid"]
+                seen.add(uuid)
+
+                entry = self.entries.get(uuid)
+                if entry is None:
+                    entry = self.entries[uuid] = _GpuEntry(gpu["index"], uuid)
+
+                entry.index = gpu["index"]
+                entry.total = int(to_number(gpu["memory_total"]))
+                entry.free = int(to_number(gpu["memory_free"]))
+                entry.pods = len(pods.get(uuid, ()))
+                entry.push_used(snapshot.timestamp, int(to_number(gpu["memory_used"])), self.window)
+
+                headroom = entry.headroom
+                key = (headroom // self.bucket, entry.pods, headroom, uuid)
+                if key != entry.key:
+                    self._remove_key(entry.key)
+                    bisect.insort(self.keys, key)
+                    entry.key = key
+
+            for uuid in [uuid for uuid in self.entries if uuid not in seen]:
+                self._remove_key(self.entries.pop(uuid).key)
+
+    def _remove_key(self, key: Optional[Tuple[int, int, int, str]]) -> None:
+        """Remove a key from the sorted list"""
+        if key is None:
+            return
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            del self.keys[position]
+
+    def query(self, memory_mib: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Get the GPUs that can fit a memory requirement, best fit first
+
+        Args:
+            memory_mib: Required memory in MiB
+            limit: Maximum number of candidates, all if None
+
+        Returns:
+            List of candidate GPUs with their placement data
+        """
+        with self.lock:
+            start = bisect.bisect_left(self.keys, (memory_mib // self.bucket,))
+
+            candidates = []
+            for _, pods, headroom, uuid in itertools.islice(self.keys, start, None):
+                if limit is not None and len(candidates) >= limit:
+                    break
+                # Only the first bucket holds GPUs with too little headroom
+                if headroom < memory_mib:
+                    continue
+                entry = self.entries[uuid]
+                candidates.append({
+                    "gpu": to_number(entry.index),
+                    "uuid": uuid,
+                    "headroom_mib": headroom,
+                    "free_mib": entry.free,
+                    "peak_used_mib": entry.peak_used,
+                    "total_mib": entry.total,
+                    "pods": pods,
+                })
+            return candidates
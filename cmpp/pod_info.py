@@ -17,32 +17,49 @@ limitations under the License.
 """
 
 import logging
-import os
 import re
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 
 
 logger = logging.getLogger("cmpp")
 
 
-def get_container_id(pid: int) -> Optional[str]:
+def read_proc_file(path: str) -> Optional[bytes]:
+    """
+    Read a /proc file
+    
+    Args:
+        path: Path of the file
+        
+    Returns:
+        File content, or None if the file does not exist or cannot be read
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        logger.debug(f"Cannot read {path}: {e}")
+        return None
+
+
+def get_container_id(pid: int, read_file: Callable[[str], Optional[bytes]] = read_proc_file) -> Optional[str]:
     """
     Extract container ID from process cgroup file
     
     Args:
         pid: Process ID
+        read_file: Callable returning the content of a /proc file, None if it cannot be read
         
     Returns:
         Container ID or None if not found
     """
     cgroup_file = f"/proc/{pid}/cgroup"
     
-    if not os.path.exists(cgroup_file):
-        return None
-    
     try:
-        with open(cgroup_file, 'r') as f:
-            cgroup_content = f.read()
+        cgroup_content = read_file(cgroup_file)
+        if cgroup_content is None:
+            return None
+        cgroup_content = cgroup_content.decode('utf-8', errors='ignore')
         
         # Try containerd format with cri prefix (K8s 1.23+)
         match = re.search(r'cri-containerd-([a-f0-9]{64})', cgroup_content)
@@ -76,28 +93,28 @@ def get_container_id(pid: int) -> Optional[str]:
         return None
 
 
-def get_pod_info(pid: int) -> str:
+def get_pod_info(pid: int, read_file: Callable[[str], Optional[bytes]] = read_proc_file) -> str:
     """
     Extract Kubernetes pod information from process environment
     
     Args:
         pid: Process ID
+        read_file: Callable returning the content of a /proc file, None if it cannot be read
         
     Returns:
         Prometheus labels string with pod information, or empty string if not found
     """
     environ_file = f"/proc/{pid}/environ"
     
-    if not os.path.exists(environ_file):
-        return ""
-    
     pod_name = ""
     namespace = ""
     stack_id = ""
     
     try:
-        with open(environ_file, 'rb') as f:
-            env_vars = f.read().split(b'\0')
+        environ = read_file(environ_file)
+        if environ is None:
+            return ""
+        env_vars = environ.split(b'\0')
         
         # Convert to string and split by '='
         env_dict = {}
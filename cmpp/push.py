@@ -0,0 +1,101 @@
+"""
+Prometheus Pushgateway sink for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+import urllib.parse
+import urllib.request
+
+
+PUSH_TIMEOUT = 10
+
+
+class PushSink:
+    """
+    Push snapshots to a Prometheus Pushgateway from a background thread
+
+    Only the newest snapshot is pushed: snapshots published while a push is
+    in flight replace each other, so a slow gateway never delays collection.
+    """
+
+    def __init__(self, url: str, hostname: str, job: str = "cmpp"):
+        """
+        Initialize the push sink
+
+        Args:
+            url: Base URL of the Pushgateway, e.g. http://pushgateway:9091
+            hostname: Value of the instance grouping key
+            job: Value of the job grouping key
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.url = (f"{url.rstrip('/')}/metrics/job/{urllib.parse.quote(job, safe='')}"
+                    f"/instance/{urllib.parse.quote(hostname, safe='')}")
+        self.condition = threading.Condition()
+        self.pending = None
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        """Start the push thread"""
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._push_loop,
+            daemon=True,
+            name="CMPurplePillPush"
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the push thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=PUSH_TIMEOUT + 1)
+
+    def publish(self, snapshot) -> None:
+        """Queue a snapshot for pushing, replacing one that was not pushed yet"""
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def _push_loop(self) -> None:
+        """Push the newest snapshot whenever one is queued"""
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                snapshot, self.pending = self.pending, None
+
+            self._push(snapshot)
+
+    def _push(self, snapshot) -> None:
+        """PUT a snapshot, replacing the metrics of the grouping key"""
+        request = urllib.request.Request(
+            self.url,
+            data=snapshot.data,
+            method='PUT',
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT):
+                pass
+        except Exception as e:
+            self.logger.error(f"Failed to push metrics to {self.url}: {e}")
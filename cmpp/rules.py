@@ -0,0 +1,432 @@
+"""
+Local rules engine and event delivery for CM PurplePill
+
+Rules are loaded from a JSON file holding a list of rule objects:
+
+    [
+        {"name": "gpu-memory-high", "type": "memory_used_ratio", "threshold": 0.9},
+        {"name": "gpu-idle", "type": "utilization_below", "threshold": 5},
+        {"name": "utilization-drop", "type": "utilization_drop", "delta": 50},
+        {"name": "pod-arrived", "type": "new_pod"},
+        {"name": "unattributed", "type": "unattributed_process"}
+    ]
+
+Condition rules (memory_used_ratio, utilization_below) produce "firing" and
+"resolved" events when their condition changes on a GPU. Change rules
+(utilization_drop, new_pod, unattributed_process) produce an "event" each
+time the change is observed between two collections.
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from cmpp.utils import parse_labels, to_number
+
+
+# Events buffered per SSE subscriber before it is considered too slow and dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Webhook batching
+WEBHOOK_BATCH_INTERVAL = 1.0
+WEBHOOK_MAX_BATCH = 100
+WEBHOOK_TIMEOUT = 5
+
+# Events buffered for the webhooks; the oldest are dropped while they are down
+WEBHOOK_QUEUE_SIZE = 10000
+WEBHOOK_DROP_WARNING_INTERVAL = 60
+
+
+class GpuView:
+    """Typed per-GPU values of a snapshot, as seen by the rules"""
+
+    __slots__ = ("index", "uuid", "memory_used", "memory_total", "utilization", "pods", "unattributed")
+
+    def __init__(self, gpu: Dict[str, Any]):
+        self.index = gpu["index"]
+        self.uuid = gpu["uuid"]
+        self.memory_used = float(to_number(gpu["memory_used"]))
+        self.memory_total = float(to_number(gpu["memory_total"]))
+        self.utilization = float(to_number(gpu["utilization"]))
+        # Pod labels string -> pod labels of the pods on this GPU
+        self.pods: Dict[str, Dict[str, str]] = {}
+        # PIDs of processes without pod information
+        self.unattributed: Set[int] = set()
+
+
+def build_views(snapshot) -> Dict[str, GpuView]:
+    """
+    Convert a snapshot into per-GPU views
+
+    Args:
+        snapshot: MetricsSnapshot with GPU and process data
+
+    Returns:
+        Dictionary mapping GPU UUID to its view
+    """
+    views = {gpu["uuid"]: GpuView(gpu) for gpu in snapshot.gpus}
+
+    for process in snapshot.processes:
+        view = views.get(process["gpu_uuid"])
+        if view is None:
+            continue
+        pod_labels = process.get("pod_labels")
+        if pod_labels:
+            if pod_labels not in view.pods:
+                view.pods[pod_labels] = parse_labels(pod_labels)
+        else:
+            view.unattributed.add(process["pid"])
+
+    return views
+
+
+# A compiled check returns the details of each match on a GPU, given the
+# current and the previous view (None on the first collection)
+Check = Callable[[GpuView, Optional[GpuView]], List[Dict[str, Any]]]
+
+
+class Rule:
+    """A compiled rule"""
+
+    __slots__ = ("name", "type", "condition", "check")
+
+    def __init__(self, name: str, rule_type: str, condition: bool, check: Check):
+        self.name = name
+        self.type = rule_type
+        self.condition = condition
+        self.check = check
+
+
+def _memory_used_ratio(config: Dict[str, Any]) -> Check:
+    """Match GPUs whose used memory ratio is at or above the "threshold" of the rule"""
+    threshold = float(config["threshold"])
+
+    def check(gpu, previous):
+        ratio = gpu.memory_used / gpu.memory_total if gpu.memory_total else 0.0
+        return [{"value": round(ratio, 4)}] if ratio >= threshold else []
+    return check
+
+
+def _utilization_below(config: Dict[str, Any]) -> Check:
+    """Match GPUs whose utilization is below the "threshold" of the rule"""
+    threshold = float(config["threshold"])
+
+    def check(gpu, previous):
+        return [{"value": gpu.utilization}] if gpu.utilization < threshold else []
+    return check
+
+
+def _utilization_drop(config: Dict[str, Any]) -> Check:
+    """Match GPUs whose utilization dropped by at least "delta" since the last collection"""
+    delta = float(config["delta"])
+
+    def check(gpu, previous):
+        if previous is not None and previous.utilization - gpu.utilization >= delta:
+            return [{"value": gpu.utilization, "previous": previous.utilization}]
+        return []
+    return check
+
+
+def _new_pod(config: Dict[str, Any]) -> Check:
+    """Match each pod that appeared on a GPU since the last collection"""
+    def check(gpu, previous):
+        if previous is None:
+            return []
+        return [dict(labels) for key, labels in gpu.pods.items() if key not in previous.pods]
+    return check
+
+
+def _unattributed_process(config: Dict[str, Any]) -> Check:
+    """Match each process without pod information that appeared on a GPU since the last collection"""
+    def check(gpu, previous):
+        if previous is None:
+            return []
+        return [{"pid": pid} for pid in sorted(gpu.unattributed - previous.unattributed)]
+    return check
+
+
+# Rule type -> (is a condition rule, check factory)
+RULE_TYPES = {
+    "memory_used_ratio": (True, _memory_used_ratio),
+    "utilization_below": (True, _utilization_below),
+    "utilization_drop": (False, _utilization_drop),
+    "new_pod": (False, _new_pod),
+    "unattributed_process": (False, _unattributed_process),
+}
+
+
+def compile_rule(config: Dict[str, Any]) -> Rule:
+    """
+    Compile a rule from its configuration
+
+    Args:
+        config: Rule object with "name", "type" and the type's parameters
+
+    Returns:
+        Compiled rule
+
+    Raises:
+        ValueError: If the rule is invalid
+    """
+    try:
+        name = str(config["name"])
+        condition, factory = RULE_TYPES[config["type"]]
+        return Rule(name, config["type"], condition, factory(config))
+    except KeyError as e:
+        raise ValueError(f"Invalid rule {config!r}: missing or unknown {e}")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid rule {config!r}: {e}")
+
+
+def load_rules(path: str) -> List[Rule]:
+    """
+    Load and compile the rules of a JSON rules file
+
+    Args:
+        path: Path of the rules file
+
+    Returns:
+        List of compiled rules
+
+    Raises:
+        ValueError: If the file is not valid JSON or holds an invalid rule
+    """
+    with open(path, 'r') as f:
+        try:
+            configs = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"Invalid rules file {path}: {e}")
+
+    if not isinstance(configs, list):
+        raise ValueError(f"Invalid rules file {path}: expected a list of rules")
+
+    return [compile_rule(config) for config in configs]
+
+
+class RulesEngine:
+    """Evaluate the rules against every snapshot and publish the resulting events"""
+
+    def __init__(self, rules: List[Rule], hostname: str = ""):
+        """
+        Initialize the rules engine
+
+        Args:
+            rules: Compiled rules
+            hostname: Hostname reported in the events
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.rules = rules
+        self.hostname = hostname
+        self.sinks: List[Callable[[List[Dict[str, Any]]], None]] = []
+        self.previous: Dict[str, GpuView] = {}
+        # (rule name, GPU UUID) of the condition rules currently firing
+        self.firing: Set[Tuple[str, str]] = set()
+
+    def add_sink(self, sink: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Register a callable receiving the events of each evaluation"""
+        self.sinks.append(sink)
+
+    def evaluate(self, snapshot) -> List[Dict[str, Any]]:
+        """
+        Evaluate all rules against a snapshot and publish the transitions
+
+        Args:
+            snapshot: MetricsSnapshot with GPU and process data
+
+        Returns:
+            Events produced by this evaluation
+        """
+        views = build_views(snapshot)
+        events = []
+
+        def event(rule, gpu, state, details):
+            events.append(dict(details, rule=rule.name, type=rule.type, state=state,
+                               gpu=to_number(gpu.index), uuid=gpu.uuid, hostname=self.hostname,
+                               seq=snapshot.seq, timestamp=snapshot.timestamp))
+
+        for rule in self.rules:
+            for uuid, gpu in views.items():
+                matches = rule.check(gpu, self.previous.get(uuid))
+
+                if not rule.condition:
+                    for details in matches:
+                        event(rule, gpu, "event", details)
+                    continue
+
+                key = (rule.name, uuid)
+                if matches and key not in self.firing:
+                    self.firing.add(key)
+                    event(rule, gpu, "firing", matches[0])
+                elif not matches and key in self.firing:
+                    self.firing.discard(key)
+                    event(rule, gpu, "resolved", {})
+
+        # Forget firing state of GPUs that disappeared
+        self.firing = {key for key in self.firing if key[1] in views}
+        self.previous = views
+
+        if events:
+            for sink in self.sinks:
+                try:
+                    sink(events)
+                except Exception as e:
+                    self.logger.error(f"Error publishing rule events: {e}")
+
+        return events
+
+
+class EventBus:
+    """Fan out events to Server-Sent Events subscribers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: Set[queue.Queue] = set()
+
+    def subscribe(self) -> queue.Queue:
+        """Register a subscriber and return its event queue"""
+        subscriber = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        """Remove a subscriber"""
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, events: List[Dict[str, Any]]) -> None:
+        """Queue events for every subscriber, dropping subscribers that fell behind"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                for event in events:
+                    subscriber.put_nowait(event)
+            except queue.Full:
+                self.unsubscribe(subscriber)
+
+    def is_subscribed(self, subscriber: queue.Queue) -> bool:
+        """Check whether a subscriber is still registered"""
+        with self.lock:
+            return subscriber in self.subscribers
+
+
+class WebhookSink:
+    """Deliver events to webhooks in batches from a background thread"""
+
+    def __init__(self, urls: List[str], batch_interval: float = WEBHOOK_BATCH_INTERVAL):
+        """
+        Initialize the webhook sink
+
+        Args:
+            urls: Webhook URLs receiving a POST with a JSON list of events
+            batch_interval: Seconds to collect events before sending a batch
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.urls = urls
+        self.batch_interval = batch_interval
+        self.queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.dropped = 0
+        self.last_drop_warning = None
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        """Start the delivery thread"""
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._delivery_loop,
+            daemon=True,
+            name="CMPurplePillWebhooks"
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the delivery thread, sending the events already queued"""
+        self.running = False
+        if self.thread and self.thread.is_alive():
+            self._put(None)
+            self.thread.join(timeout=WEBHOOK_TIMEOUT * len(self.urls) + 1)
+
+    def publish(self, events: List[Dict[str, Any]]) -> None:
+        """Queue events for delivery, dropping the oldest queued events when the queue is full"""
+        for event in events:
+            self._put(event)
+
+    def _put(self, item: Optional[Dict[str, Any]]) -> None:
+        """Queue an item without blocking, making room by dropping the oldest one"""
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+
+            try:
+                if self.queue.get_nowait() is not None:
+                    self._dropped()
+            except queue.Empty:
+                pass
+
+    def _dropped(self) -> None:
+        """Count a dropped event and warn about the drops at most every WEBHOOK_DROP_WARNING_INTERVAL"""
+        self.dropped += 1
+        now = time.monotonic()
+        if self.last_drop_warning is None or now - self.last_drop_warning >= WEBHOOK_DROP_WARNING_INTERVAL:
+            self.logger.warning(f"Webhook queue full, dropped {self.dropped} events since the last warning")
+            self.dropped = 0
+            self.last_drop_warning = now
+
+    def _delivery_loop(self) -> None:
+        """Collect events for batch_interval after the first one, then send them"""
+        while self.running or not self.queue.empty():
+            event = self.queue.get()
+            if event is None:
+                continue
+
+            batch = [event]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < WEBHOOK_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is None:
+                    break
+                batch.append(event)
+
+            self._send(batch)
+
+    def _send(self, batch: List[Dict[str, Any]]) -> None:
+        """POST a batch of events to every webhook"""
+        body = json.dumps(batch, separators=(",", ":")).encode('utf-8')
+
+        for url in self.urls:
+            request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT):
+                    pass
+            except Exception as e:
+                self.logger.error(f"Failed to deliver {len(batch)} events to webhook {url}: {e}")
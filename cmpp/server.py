@@ -17,10 +17,17 @@ limitations under the License.
 """
 
 import http.server
+import json
 import logging
+import queue
 import socketserver
 import threading
-from typing import Any, Dict, Optional, Union
+import urllib.parse
+from typing import Any, Dict, List, Optional, Union
+
+# Seconds between keepalive comments on idle event streams
+SSE_KEEPALIVE_INTERVAL = 15
+
 
 # ThreadingMixIn allows handling requests concurrently
 class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
@@ -31,34 +38,170 @@ class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
 class MetricsHandler(http.server.BaseHTTPRequestHandler):
     """HTTP request handler for Prometheus metrics"""
     
-    # This will be set by the MetricsServer class
+    # These will be set by the MetricsServer class
     collector = None
+    placement = None
+    events = None
     
     def do_GET(self):
         """Handle GET requests"""
-        if self.path == '/metrics' or self.path == '/':
-            self._serve_metrics()
-        elif self.path == '/health':
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        
+        if url.path == '/metrics' or url.path == '/':
+            self._serve_metrics(query)
+        elif url.path == '/api/v1/snapshot':
+            self._serve_snapshot(query)
+        elif url.path == '/api/v1/placement':
+            self._serve_placement(query)
+        elif url.path == '/api/v1/events':
+            self._serve_events()
+        elif url.path == '/health':
             self._serve_health()
         else:
             self.send_error(404, "Not Found")
     
-    def _serve_metrics(self):
-        """Serve metrics in Prometheus format"""
+    def _serve_metrics(self, query: Dict[str, List[str]]):
+        """
+        Serve metrics in Prometheus format
+        
+        Supported query parameters (repeatable):
+            collect[]: metric family section, e.g. memory, utilization, energy
+            name[]: full metric family name
+            gpu[]: GPU index or UUID
+            namespace[]: Kubernetes namespace, selects pod metrics only
+        """
         if not self.collector:
             self.send_error(500, "Metrics collector not configured")
             return
         
-        # Get current metrics
-        metrics = self.collector.get_current_metrics()
+        # Get current metrics, sliced from the indexed snapshot when filtered
+        snapshot = self.collector.get_current_snapshot()
+        metrics = snapshot.filter(
+            names=_get_param(query, 'name'),
+            sections=_get_param(query, 'collect'),
+            gpus=_get_param(query, 'gpu'),
+            namespaces=_get_param(query, 'namespace')
+        )
         
         # Send response
         self.send_response(200)
-        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
         self.send_header('Content-Length', str(len(metrics)))
         self.send_header('Access-Control-Allow-Origin', '*')
+        if snapshot.stale:
+            self.send_header('X-CMPP-Stale', '1')
         self.end_headers()
-        self.wfile.write(metrics.encode('utf-8'))
+        self.wfile.write(metrics)
+    
+    def _serve_snapshot(self, query: Dict[str, List[str]]):
+        """
+        Serve the current collection as columnar JSON
+        
+        Responds 304 Not Modified if the client has the current collection:
+        its sequence number is passed as ?since=<seq> (with the optional
+        ?epoch=<epoch> of the snapshot it came from), or its ETag as
+        If-None-Match.
+        """
+        if not self.collector:
+            self.send_error(500, "Metrics collector not configured")
+            return
+        
+        snapshot = self.collector.get_current_snapshot()
+        if snapshot.seq == 0:
+            self.send_error(503, "No collection available yet")
+            return
+        
+        since = query.get('since', [None])[0]
+        epoch = query.get('epoch', [None])[0]
+        if since is not None and not since.isdigit():
+            self.send_error(400, "Invalid since parameter")
+            return
+        
+        # Any other sequence number is outdated, including one from before a restart
+        if (self.headers.get('If-None-Match') == snapshot.etag
+                or (since is not None and int(since) == snapshot.seq and epoch in (None, snapshot.epoch))):
+            self.send_response(304)
+            self.send_header('ETag', snapshot.etag)
+            self.end_headers()
+            return
+        
+        body = snapshot.to_json()
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', snapshot.etag)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _serve_placement(self, query: Dict[str, List[str]]):
+        """
+        Serve GPUs that can fit ?memory_mib=N, ranked best fit first
+        
+        Optional ?limit=K returns at most K candidates.
+        """
+        if not self.placement:
+            self.send_error(404, "Placement index not configured")
+            return
+        
+        memory_mib = query.get('memory_mib', [''])[0]
+        limit = query.get('limit', [None])[0]
+        if not memory_mib.isdigit() or (limit is not None and not limit.isdigit()):
+            self.send_error(400, "memory_mib and limit must be non-negative integers")
+            return
+        
+        if not self.placement.seq:
+            self.send_error(503, "No collection available yet")
+            return
+        
+        candidates = self.placement.query(int(memory_mib), int(limit) if limit is not None else None)
+        body = json.dumps({
+            "seq": self.placement.seq,
+            "memory_mib": int(memory_mib),
+            "candidates": candidates
+        }, separators=(",", ":")).encode('utf-8')
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _serve_events(self):
+        """Stream rule events as Server-Sent Events until the client disconnects"""
+        if not self.events:
+            self.send_error(404, "Rules engine not configured")
+            return
+        
+        subscriber = self.events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.flush()
+            
+            while True:
+                try:
+                    event = subscriber.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    # Dropped for falling behind, or idle: keep the connection alive
+                    if not self.events.is_subscribed(subscriber):
+                        break
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                
+                data = json.dumps(event, separators=(",", ":"))
+                self.wfile.write(f"event: {event['state']}\ndata: {data}\n\n".encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.events.unsubscribe(subscriber)
     
     def _serve_health(self):
         """Serve health check response"""
@@ -76,10 +219,16 @@ class MetricsHandler(http.server.BaseHTTPRequestHandler):
         logger.debug(f"{self.client_address[0]} - {format % args}")
 
 
+def _get_param(query: Dict[str, List[str]], name: str) -> Optional[List[str]]:
+    """Get the values of a query parameter given as name[] or name"""
+    values = query.get(f"{name}[]", []) + query.get(name, [])
+    return values or None
+
+
 class MetricsServer:
     """HTTP server for exposing Prometheus metrics"""
     
-    def __init__(self, collector, host: str = '0.0.0.0', port: int = 9531):
+    def __init__(self, collector, host: str = '0.0.0.0', port: int = 9531, placement=None, events=None):
         """
         Initialize the metrics server
         
@@ -87,11 +236,15 @@ class MetricsServer:
             collector: MetricsCollector instance
             host: Host to bind the server to
             port: Port to listen on
+            placement: Optional PlacementIndex backing /api/v1/placement
+            events: Optional EventBus backing /api/v1/events
         """
         self.logger = logging.getLogger("cmpp")
         self.host = host
         self.port = port
         self.collector = collector
+        self.placement = placement
+        self.events = events
         self.server = None
         self.thread = None
         self.running = False
@@ -110,6 +263,8 @@ class MetricsServer:
         try:
             # Set collector instance to be used by request handler
             MetricsHandler.collector = self.collector
+            MetricsHandler.placement = self.placement
+            MetricsHandler.events = self.events
             
             # Create server instance
             self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
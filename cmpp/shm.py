@@ -0,0 +1,270 @@
+"""
+Shared-memory snapshot for co-located consumers of CM PurplePill
+
+The collector publishes every snapshot into a memory-mapped file with a
+fixed binary layout, so node-local agents can read GPU memory and the
+process/pod table without HTTP or text parsing:
+
+    header    HEADER_FORMAT, at offset 0
+    GPUs      MAX_GPUS records of GPU_FORMAT, at HEADER_SIZE
+    processes MAX_PROCESSES records of PROCESS_FORMAT, after the GPU records
+
+Strings are UTF-8, NUL padded and truncated to their field size. Writes are
+guarded by a seqlock: the writer makes the lock counter odd, updates the
+records and makes it even again. Readers never block the writer; they
+retry when the counter was odd or changed while they were reading.
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Any, Dict, List, Optional
+
+from cmpp.utils import parse_labels, to_number
+
+
+DEFAULT_SHM_PATH = "/dev/shm/cmpp-snapshot"
+
+MAGIC = b"CMPP"
+LAYOUT_VERSION = 1
+
+MAX_GPUS = 64
+MAX_PROCESSES = 1024
+
+# magic, layout version, reserved, seqlock counter, snapshot seq, timestamp, GPU count, process count
+HEADER_FORMAT = struct.Struct("<4sHHQQdII")
+# index, UUID, name, memory total/used/free in MiB, utilization percentage
+GPU_FORMAT = struct.Struct("<i48s64sIIIf")
+# PID, GPU record number, memory used in MiB, namespace, pod, stack ID
+PROCESS_FORMAT = struct.Struct("<IiI64s128s64s")
+
+HEADER_SIZE = HEADER_FORMAT.size
+GPUS_OFFSET = HEADER_SIZE
+PROCESSES_OFFSET = GPUS_OFFSET + MAX_GPUS * GPU_FORMAT.size
+REGION_SIZE = PROCESSES_OFFSET + MAX_PROCESSES * PROCESS_FORMAT.size
+
+# Offset of the seqlock counter within the header
+_SEQLOCK = struct.Struct("<Q")
+_SEQLOCK_OFFSET = 8
+
+# Reads are retried for this many seconds before giving up on a busy writer
+READ_TIMEOUT = 1.0
+
+
+def _encode(value: Optional[str], size: int) -> bytes:
+    """Encode a string field, truncated to size bytes"""
+    return (value or "").encode("utf-8")[:size]
+
+
+def _decode(value: bytes) -> str:
+    """Decode a NUL padded string field"""
+    return value.rstrip(b"\0").decode("utf-8", errors="ignore")
+
+
+class SharedSnapshotWriter:
+    """Publish snapshots into the shared-memory region"""
+
+    def __init__(self, path: str = DEFAULT_SHM_PATH):
+        """
+        Create or reuse the shared-memory file
+
+        An existing file is reused rather than replaced, so readers that
+        already mapped it keep seeing new snapshots after a restart.
+
+        Args:
+            path: Path of the memory-mapped file, normally under /dev/shm
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.path = path
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, REGION_SIZE)
+            self.map = mmap.mmap(fd, REGION_SIZE, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+
+        # Continue the seqlock counter of a previous writer, even if it died mid-write
+        self.lock_counter = _SEQLOCK.unpack_from(self.map, _SEQLOCK_OFFSET)[0] | 1
+        self._write_header(0, 0.0, 0, 0)
+        self.lock_counter += 1
+        _SEQLOCK.pack_into(self.map, _SEQLOCK_OFFSET, self.lock_counter)
+
+    def _write_header(self, seq: int, timestamp: float, gpu_count: int, process_count: int) -> None:
+        """Write the header with the current seqlock counter"""
+        HEADER_FORMAT.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, 0, self.lock_counter,
+                                seq, timestamp, gpu_count, process_count)
+
+    def publish(self, snapshot) -> None:
+        """
+        Write a snapshot into the region
+
+        Args:
+            snapshot: MetricsSnapshot with GPU and process data
+        """
+        gpus = snapshot.gpus[:MAX_GPUS]
+        processes = snapshot.processes[:MAX_PROCESSES]
+        if len(snapshot.processes) > MAX_PROCESSES:
+            self.logger.warning(f"Shared-memory snapshot truncated to {MAX_PROCESSES} processes")
+
+        slots = {gpu["uuid"]: slot for slot, gpu in enumerate(gpus)}
+
+        # Odd counter: write in progress
+        self.lock_counter += 1
+        _SEQLOCK.pack_into(self.map, _SEQLOCK_OFFSET, self.lock_counter)
+
+        for slot, gpu in enumerate(gpus):
+            GPU_FORMAT.pack_into(
+                self.map, GPUS_OFFSET + slot * GPU_FORMAT.size,
+                int(gpu["index"]), _encode(gpu["uuid"], 48), _encode(gpu["name"], 64),
+                int(to_number(gpu["memory_total"])), int(to_number(gpu["memory_used"])),
+                int(to_number(gpu["memory_free"])), float(gpu["utilization"])
+            )
+
+        for slot, process in enumerate(processes):
+            pod = parse_labels(process.get("pod_labels", ""))
+            PROCESS_FORMAT.pack_into(
+                self.map, PROCESSES_OFFSET + slot * PROCESS_FORMAT.size,
+                process["pid"], slots.get(process["gpu_uuid"], -1), int(to_number(process["memory_used"])),
+                _encode(pod.get("namespace"), 64), _encode(pod.get("pod"), 128), _encode(pod.get("stack_id"), 64)
+            )
+
+        self._write_header(snapshot.seq, snapshot.timestamp, len(gpus), len(processes))
+
+        # Even counter: write complete
+        self.lock_counter += 1
+        _SEQLOCK.pack_into(self.map, _SEQLOCK_OFFSET, self.lock_counter)
+
+    def close(self) -> None:
+        """Unmap the region, leaving the file in place for readers"""
+        self.map.close()
+
+
+class SharedSnapshotReader:
+    """
+    Read snapshots from the shared-memory region
+
+    Fields are unpacked straight from the mapping without copying the
+    region. Example:
+
+        with SharedSnapshotReader() as reader:
+            free = reader.free_memory()   # {"GPU-...": 80896, ...}
+    """
+
+    def __init__(self, path: str = DEFAULT_SHM_PATH):
+        """
+        Map the shared-memory file read-only
+
+        Args:
+            path: Path of the memory-mapped file written by the collector
+        """
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), REGION_SIZE, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER_FORMAT.unpack_from(self.map, 0)[:2]
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            self.map.close()
+            raise ValueError(f"{path} is not a CM PurplePill snapshot (layout {LAYOUT_VERSION})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        """Unmap the region"""
+        self.map.close()
+
+    def _consistent(self, read):
+        """Run read() until it observed a snapshot that was not modified meanwhile"""
+        deadline = None
+        while True:
+            before = _SEQLOCK.unpack_from(self.map, _SEQLOCK_OFFSET)[0]
+            if before % 2 == 0:
+                result = read()
+                if _SEQLOCK.unpack_from(self.map, _SEQLOCK_OFFSET)[0] == before:
+                    return result
+
+            # Write in progress: yield to the writer and retry
+            if deadline is None:
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise TimeoutError("Shared-memory snapshot kept changing while reading")
+            time.sleep(0)
+
+    def seq(self) -> int:
+        """Get the sequence number of the published snapshot, 0 if none was published yet"""
+        return HEADER_FORMAT.unpack_from(self.map, 0)[4]
+
+    def free_memory(self) -> Dict[str, int]:
+        """
+        Get the free memory of every GPU
+
+        Returns:
+            Dictionary mapping GPU UUID to free memory in MiB
+        """
+        def read():
+            count = HEADER_FORMAT.unpack_from(self.map, 0)[6]
+            free = {}
+            for slot in range(count):
+                record = GPU_FORMAT.unpack_from(self.map, GPUS_OFFSET + slot * GPU_FORMAT.size)
+                free[_decode(record[1])] = record[5]
+            return free
+
+        return self._consistent(read)
+
+    def read(self) -> Dict[str, Any]:
+        """
+        Read the complete snapshot
+
+        Returns:
+            Dictionary with seq, timestamp, a list of GPU dictionaries and a
+            list of process dictionaries with their pod attribution
+        """
+        def read():
+            header = HEADER_FORMAT.unpack_from(self.map, 0)
+            _, _, _, _, seq, timestamp, gpu_count, process_count = header
+
+            gpus = []
+            for slot in range(gpu_count):
+                index, uuid, name, total, used, free, utilization = GPU_FORMAT.unpack_from(
+                    self.map, GPUS_OFFSET + slot * GPU_FORMAT.size)
+                gpus.append({
+                    "index": index, "uuid": _decode(uuid), "name": _decode(name),
+                    "memory_total": total, "memory_used": used, "memory_free": free,
+                    "utilization": utilization,
+                })
+
+            processes = []
+            for slot in range(process_count):
+                pid, gpu_slot, memory, namespace, pod, stack_id = PROCESS_FORMAT.unpack_from(
+                    self.map, PROCESSES_OFFSET + slot * PROCESS_FORMAT.size)
+                processes.append({
+                    "pid": pid, "gpu": gpu_slot, "memory_used": memory,
+                    "namespace": _decode(namespace), "pod": _decode(pod), "stack_id": _decode(stack_id),
+                })
+
+            return {"seq": seq, "timestamp": timestamp, "gpus": gpus, "processes": processes}
+
+        result = self._consistent(read)
+        for process in result["processes"]:
+            slot = process.pop("gpu")
+            process["gpu_uuid"] = result["gpus"][slot]["uuid"] if 0 <= slot < len(result["gpus"]) else ""
+        return result
@@ -0,0 +1,359 @@
+"""
+Indexed metrics snapshots for CM PurplePill
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import re
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from cmpp.utils import parse_labels, to_number
+
+
+METRIC_PREFIX = "CM_PURPLEPILL_"
+
+# Maximum number of distinct filtered results cached per snapshot
+MAX_CACHED_FILTERS = 64
+
+# Labels used to index samples by GPU and namespace
+_INDEX_LABELS_RE = re.compile(r'(?:^|,)(gpu|UUID|namespace)="([^"]*)"')
+
+# Sample line of the text exposition format
+_SAMPLE_RE = re.compile(r'^([A-Za-z_:][A-Za-z0-9_:]*)(?:\{(.*)\})? (\S+)')
+
+
+def get_section(name: str) -> str:
+    """
+    Get the section of a metric family, used by the collect[] filter
+
+    Args:
+        name: Metric family name, e.g. CM_PURPLEPILL_GPU_MEMORY_FREE_MIB
+
+    Returns:
+        First word after the CM_PURPLEPILL_GPU_ prefix in lower case, e.g. "memory"
+    """
+    short = name[len(METRIC_PREFIX):] if name.startswith(METRIC_PREFIX) else name
+    if short.startswith("GPU_"):
+        short = short[4:]
+    return short.split("_", 1)[0].lower()
+
+
+class MetricFamily:
+    """A metric family with its samples, in exposition order"""
+
+    __slots__ = ("name", "description", "type", "samples")
+
+    def __init__(self, name: str, description: str, metric_type: str = "gauge"):
+        self.name = name
+        self.description = description
+        self.type = metric_type
+        self.samples: List[Tuple[str, str]] = []
+
+    def add(self, labels: str, value) -> None:
+        """
+        Add a sample to the family
+
+        Args:
+            labels: Prometheus labels string without braces
+            value: Sample value, formatted as is
+        """
+        self.samples.append((labels, str(value)))
+
+
+class _FamilyIndex:
+    """Byte ranges of one family within the snapshot data"""
+
+    __slots__ = ("name", "section", "start", "header_end", "end", "samples", "by_gpu", "by_namespace")
+
+    def __init__(self, name: str, section: str, start: int, header_end: int):
+        self.name = name
+        self.section = section
+        self.start = start
+        self.header_end = header_end
+        self.end = header_end
+        # (start, end, gpu index, GPU UUID, namespace) of each sample
+        self.samples: List[Tuple[int, int, str, str, str]] = []
+        self.by_gpu: Dict[str, List[Tuple[int, int]]] = {}
+        self.by_namespace: Dict[str, List[Tuple[int, int]]] = {}
+
+
+def _append_range(ranges: List[Tuple[int, int]], start: int, end: int) -> None:
+    """Append a byte range, merging it with the previous one when adjacent"""
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
+
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge sorted byte ranges that overlap or touch"""
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class MetricsSnapshot:
+    """
+    Rendered Prometheus exposition of one collection, indexed for filtering
+
+    The exposition is encoded once. Every family and every sample is indexed
+    by its byte range, per GPU and per namespace, so filtered responses are
+    built by slicing the encoded data. Filtered results are cached for the
+    life of the snapshot.
+    """
+
+    def __init__(self,
+                 families: Iterable[MetricFamily],
+                 timestamp: Optional[float] = None,
+                 stale: bool = False,
+                 seq: int = 0,
+                 hostname: str = "",
+                 gpus: Optional[List[Dict[str, Any]]] = None,
+                 processes: Optional[List[Dict[str, Any]]] = None,
+                 sources: Optional[Dict[str, float]] = None,
+                 epoch: str = ""):
+        """
+        Render and index the metric families
+
+        Args:
+            families: Metric families in exposition order
+            timestamp: Collection time, defaults to now
+            stale: True if the metrics were not collected by this process
+            seq: Collection sequence number, 0 if not collected by this process
+            hostname: Hostname used in the metric labels
+            gpus: GPU information as returned by the collector
+            processes: GPU processes, each with its "pod_labels" string
+            sources: Time of the last successful collection of each source
+            epoch: Identifier of the sequence of seq, changes when the exporter restarts
+        """
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.stale = stale
+        self.seq = seq
+        self.hostname = hostname
+        self.gpus = gpus or []
+        self.processes = processes or []
+        self.sources = sources or {}
+        self.epoch = epoch
+        self.families: Dict[str, _FamilyIndex] = {}
+        self._filter_cache: Dict[Tuple, bytes] = {}
+        self._json = None
+
+        chunks = []
+        offset = 0
+
+        for family in families:
+            header = f"# HELP {family.name} {family.description}\n# TYPE {family.name} {family.type}\n".encode("utf-8")
+            chunks.append(header)
+            index = _FamilyIndex(family.name, get_section(family.name), offset, offset + len(header))
+            offset += len(header)
+
+            for labels, value in family.samples:
+                line = f"{family.name}{{{labels}}} {value}\n".encode("utf-8")
+                chunks.append(line)
+                start, offset = offset, offset + len(line)
+
+                keys = dict(_INDEX_LABELS_RE.findall(labels))
+                gpu, uuid, namespace = keys.get("gpu", ""), keys.get("UUID", ""), keys.get("namespace", "")
+                index.samples.append((start, offset, gpu, uuid, namespace))
+
+                for key in {gpu, uuid}:
+                    if key:
+                        _append_range(index.by_gpu.setdefault(key, []), start, offset)
+                if namespace:
+                    _append_range(index.by_namespace.setdefault(namespace, []), start, offset)
+
+            index.end = offset
+            self.families[family.name] = index
+
+        self.data = b"".join(chunks)
+
+    @classmethod
+    def parse_families(cls, content: str) -> List[MetricFamily]:
+        """
+        Parse Prometheus text exposition into metric families
+
+        Comments other than HELP and TYPE are ignored.
+
+        Args:
+            content: Exposition text, e.g. the content of the metrics file
+
+        Returns:
+            Metric families in exposition order
+        """
+        families = []
+        family = None
+
+        for line in content.splitlines():
+            if line.startswith("# HELP "):
+                name, _, description = line[7:].partition(" ")
+                family = MetricFamily(name, description, "untyped")
+                families.append(family)
+            elif line.startswith("# TYPE "):
+                name, _, metric_type = line[7:].partition(" ")
+                if family is not None and family.name == name:
+                    family.type = metric_type
+            elif line and not line.startswith("#"):
+                match = _SAMPLE_RE.match(line)
+                if not match:
+                    continue
+                name, labels, value = match.groups()
+                if family is None or family.name != name:
+                    family = MetricFamily(name, "", "untyped")
+                    families.append(family)
+                family.add(labels or "", value)
+
+        return families
+
+    @property
+    def etag(self) -> str:
+        """Entity tag of the collection, unique across exporter restarts"""
+        return f'"{self.epoch}-{self.seq}"'
+
+    @property
+    def text(self) -> str:
+        """Full exposition as text"""
+        return self.data.decode("utf-8")
+
+    def to_json(self) -> bytes:
+        """
+        Get the collection as columnar JSON
+
+        GPU and process attributes are returned as parallel arrays. The
+        result is serialised on first use and cached for the life of the
+        snapshot.
+
+        Returns:
+            UTF-8 encoded JSON document
+        """
+        if self._json is None:
+            self._json = json.dumps(self._columns(), separators=(",", ":")).encode("utf-8")
+        return self._json
+
+    def _columns(self) -> Dict[str, Any]:
+        """Build the columnar representation of the collection"""
+        gpu_index = {gpu["uuid"]: gpu["index"] for gpu in self.gpus}
+        pods = [parse_labels(process.get("pod_labels", "")) for process in self.processes]
+
+        return {
+            "seq": self.seq,
+            "epoch": self.epoch,
+            "timestamp": self.timestamp,
+            "hostname": self.hostname,
+            "stale": self.stale,
+            "sources": self.sources,
+            "gpus": {
+                "index": [to_number(gpu["index"]) for gpu in self.gpus],
+                "uuid": [gpu["uuid"] for gpu in self.gpus],
+                "name": [gpu["name"] for gpu in self.gpus],
+                "memory_total_mib": [to_number(gpu["memory_total"]) for gpu in self.gpus],
+                "memory_used_mib": [to_number(gpu["memory_used"]) for gpu in self.gpus],
+                "memory_free_mib": [to_number(gpu["memory_free"]) for gpu in self.gpus],
+                "utilization": [to_number(gpu["utilization"]) for gpu in self.gpus],
+            },
+            "processes": {
+                "pid": [process["pid"] for process in self.processes],
+                "gpu_index": [to_number(gpu_index.get(process["gpu_uuid"])) for process in self.processes],
+                "gpu_uuid": [process["gpu_uuid"] for process in self.processes],
+                "memory_used_mib": [to_number(process["memory_used"]) for process in self.processes],
+                "pod": [pod.get("pod") for pod in pods],
+                "namespace": [pod.get("namespace") for pod in pods],
+                "stack_id": [pod.get("stack_id") for pod in pods],
+            },
+        }
+
+    def filter(self,
+               names: Optional[Iterable[str]] = None,
+               sections: Optional[Iterable[str]] = None,
+               gpus: Optional[Iterable[str]] = None,
+               namespaces: Optional[Iterable[str]] = None) -> bytes:
+        """
+        Get the part of the exposition matching the filters
+
+        Families are selected by exact name or by section; without either
+        all families are selected. Samples are selected by GPU index or UUID
+        and by namespace. A namespace filter only matches pod samples.
+        Families without matching samples are omitted when a sample filter
+        is given.
+
+        Args:
+            names: Metric family names
+            sections: Family sections as returned by get_section
+            gpus: GPU indexes or UUIDs
+            namespaces: Kubernetes namespaces
+
+        Returns:
+            Matching exposition bytes
+        """
+        key = (_freeze(names), _freeze(sections, str.lower), _freeze(gpus), _freeze(namespaces))
+        if key == (None, None, None, None):
+            return self.data
+
+        result = self._filter_cache.get(key)
+        if result is None:
+            result = self._filter(*key)
+            if len(self._filter_cache) < MAX_CACHED_FILTERS:
+                self._filter_cache[key] = result
+        return result
+
+    def _filter(self,
+                names: Optional[FrozenSet[str]],
+                sections: Optional[FrozenSet[str]],
+                gpus: Optional[FrozenSet[str]],
+                namespaces: Optional[FrozenSet[str]]) -> bytes:
+        """Build a filtered exposition from the indexed byte ranges"""
+        view = memoryview(self.data)
+        parts = []
+
+        for family in self.families.values():
+            if names is not None or sections is not None:
+                if not ((names and family.name in names) or (sections and family.section in sections)):
+                    continue
+
+            if gpus is None and namespaces is None:
+                parts.append(view[family.start:family.end])
+                continue
+
+            if gpus is not None and namespaces is not None:
+                ranges = []
+                for start, end, gpu, uuid, namespace in family.samples:
+                    if (gpu in gpus or uuid in gpus) and namespace in namespaces:
+                        _append_range(ranges, start, end)
+            else:
+                lookup, keys = (family.by_gpu, gpus) if gpus is not None else (family.by_namespace, namespaces)
+                ranges = _merge_ranges(sorted({r for key in keys for r in lookup.get(key, ())}))
+
+            if not ranges:
+                continue
+
+            parts.append(view[family.start:family.header_end])
+            parts.extend(view[start:end] for start, end in ranges)
+
+        return b"".join(parts)
+
+
+def _freeze(values: Optional[Iterable[str]], normalize=None) -> Optional[FrozenSet[str]]:
+    """Turn filter values into a hashable set, None when no filter is given"""
+    if values is None:
+        return None
+    values = [v for v in values if v]
+    if not values:
+        return None
+    return frozenset(normalize(v) for v in values) if normalize else frozenset(values)
@@ -0,0 +1,426 @@
+"""
+Collector process supervision for CM PurplePill
+
+In multiprocess mode the collection runs in a child process, so scrapes
+served by the parent and the collection do not compete for one GIL, and
+a crashed or leaking collector does not take the HTTP server with it.
+
+The child runs a MetricsCollector with the sinks that only need the
+snapshot it produced (metrics file, shared memory, Pushgateway, trace
+recording) and sends every snapshot, pre-encoded and indexed, to the
+parent over a pipe. The parent serves the last snapshot it received,
+runs the listeners that answer queries (placement index, rules), and
+restarts the child with exponential backoff when it exits or exceeds
+its memory limit. Every child records its own part of the trace, so a
+restart keeps the trace of the child that failed.
+
+Messages from the child are tuples:
+
+    ("started", None)           sinks are set up, collection starts
+    ("error", message)          setup failed, the child exits
+    ("snapshot", snapshot)      a MetricsSnapshot, stale on warm start
+    ("ready", available)        first collection finished, see wait_first_collection
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from cmpp.collector import MetricsCollector
+from cmpp.pod_info import read_proc_file
+from cmpp.push import PushSink
+from cmpp.shm import SharedSnapshotWriter
+from cmpp.snapshot import MetricsSnapshot
+from cmpp.utils import setup_logging
+
+
+# Restart backoff of the collector process in seconds, doubled per restart
+RESTART_BACKOFF_MIN = 1
+RESTART_BACKOFF_MAX = 60
+
+# A collector process running this long resets the backoff
+STABLE_RUNTIME = 60
+
+# Seconds to wait for a new collector process to set up its sinks
+START_TIMEOUT = 30
+
+# Seconds to wait for the collector process to exit before killing it
+STOP_TIMEOUT = 5
+
+
+def get_rss_mib(pid: int) -> Optional[float]:
+    """
+    Get the resident memory of a process
+
+    Args:
+        pid: Process ID
+
+    Returns:
+        VmRSS in MiB, or None if the process is gone
+    """
+    status = read_proc_file(f"/proc/{pid}/status")
+    if status is None:
+        return None
+    for line in status.splitlines():
+        if line.startswith(b"VmRSS:"):
+            return int(line.split()[1]) / 1024
+    return None
+
+
+def _collector_process(connection,
+                       options: Dict[str, Any],
+                       sinks: Dict[str, Any],
+                       log_file: Optional[str],
+                       seq: int,
+                       epoch: str,
+                       part: int) -> None:
+    """
+    Entry point of the collector process
+
+    Args:
+        connection: Child end of the pipe to the parent
+        options: Keyword arguments of MetricsCollector
+        sinks: Optional "record", "shm_file" and "push_url" of the child
+        log_file: Log file path
+        seq: Sequence number of the last snapshot the parent received
+        epoch: Epoch of the sequence, kept for the life of the parent
+        part: Number of this collector process, the part of the trace it records
+    """
+    logger = setup_logging(log_file, level=logging.INFO)
+
+    # The parent handles interrupts and stops this process with SIGTERM
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda sig, frame: stopping.set())
+    parent = os.getppid()
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    def publish(snapshot):
+        send(("snapshot", snapshot))
+
+    collector = MetricsCollector(**options)
+    # Continue the sequence of the previous collector process
+    collector.seq = seq
+    collector.epoch = epoch
+
+    try:
+        if sinks.get("record"):
+            collector.record(sinks["record"], part=part)
+        if sinks.get("shm_file"):
+            shm_writer = SharedSnapshotWriter(sinks["shm_file"])
+            collector.add_listener(shm_writer.publish)
+    except OSError as e:
+        send(("error", str(e)))
+        return
+
+    push = None
+    if sinks.get("push_url"):
+        push = PushSink(sinks["push_url"], hostname=collector.hostname)
+        collector.add_listener(push.publish)
+        push.start()
+
+    collector.add_listener(publish)
+    send(("started", None))
+
+    collector.start()
+    snapshot = collector.get_current_snapshot()
+    if snapshot.stale:
+        publish(snapshot)
+
+    ready = False
+    while not stopping.wait(1):
+        if os.getppid() != parent:
+            logger.warning("Parent process exited, stopping the collector process")
+            break
+
+        if not ready and collector.first_collection.is_set():
+            send(("ready", collector.nvidia_available))
+            ready = True
+
+        if collector.thread and not collector.thread.is_alive():
+            logger.warning("Metrics collector died, restarting...")
+            collector.start()
+
+    collector.close()
+    if push:
+        push.stop()
+
+
+class CollectorProcess:
+    """
+    Run a MetricsCollector in a supervised child process
+
+    Offers the interface of MetricsCollector used by the HTTP server,
+    the listeners and main: the current snapshot, listeners invoked with
+    every snapshot received from the child, and the first collection.
+    """
+
+    def __init__(self,
+                 options: Dict[str, Any],
+                 sinks: Optional[Dict[str, Any]] = None,
+                 memory_limit: Optional[float] = None,
+                 log_file: Optional[str] = None):
+        """
+        Initialize the collector process supervisor
+
+        Args:
+            options: Keyword arguments of MetricsCollector, see its documentation
+            sinks: Optional "record", "shm_file" and "push_url" run by the child
+            memory_limit: Resident memory in MiB above which the child is restarted
+            log_file: Log file path of the child
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.options = options
+        self.sinks = sinks or {}
+        self.memory_limit = memory_limit
+        self.log_file = log_file
+        self.hostname = options.get("hostname_override") or socket.gethostname()
+        self.context = multiprocessing.get_context("spawn")
+        self.running = False
+        self.stopped = threading.Event()
+        self.thread = None
+        self.process = None
+        self.connection = None
+        self.metrics_lock = threading.Lock()
+        self.current_snapshot = MetricsSnapshot([], hostname=self.hostname)
+        self.restarts = 0
+        # Collector processes spawned, each recording its own part of the trace
+        self.spawned = 0
+        # Epoch of the snapshot sequence, which restarted collector processes continue
+        self.epoch = os.urandom(4).hex()
+
+        # Callables invoked with each new snapshot from the supervisor thread
+        self.listeners = []
+
+        # Set once the first collection of the first collector process finished
+        self.first_collection = threading.Event()
+        self.nvidia_available = None
+
+    def start(self) -> bool:
+        """
+        Start the collector process and its supervisor thread
+
+        Returns:
+            True if started successfully, False otherwise
+        """
+        if self.running:
+            self.logger.warning("Metrics collector is already running")
+            return False
+
+        if self.process is None or not self.process.is_alive():
+            error = self._spawn()
+            if error:
+                self.logger.error(f"Failed to start the collector process: {error}")
+                self._terminate()
+                return False
+
+        self.running = True
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._supervise_loop,
+            daemon=True,
+            name="CMPurplePillSupervisor"
+        )
+        self.thread.start()
+        self.logger.info(f"Collector process {self.process.pid} started")
+        return True
+
+    def stop(self) -> None:
+        """Stop the supervisor thread and the collector process"""
+        self.running = False
+        self.stopped.set()
+        self._terminate()
+        if self.thread and self.thread.is_alive():
+            self.thread.join(timeout=STOP_TIMEOUT)
+            self.logger.info("Metrics collector stopped")
+
+    def close(self) -> None:
+        """Stop the collection for good; the collector process releases its own sources"""
+        self.stop()
+
+    def add_listener(self, listener: Callable[[MetricsSnapshot], None]) -> None:
+        """
+        Register a callable to be invoked with every new snapshot
+
+        Listeners run in the supervisor thread of this process, so they
+        should return quickly.
+
+        Args:
+            listener: Callable taking the new MetricsSnapshot
+        """
+        self.listeners.append(listener)
+
+    def get_current_metrics(self) -> str:
+        """
+        Get the current metrics
+
+        Returns:
+            Current metrics in Prometheus format
+        """
+        return self.get_current_snapshot().text
+
+    def get_current_snapshot(self) -> MetricsSnapshot:
+        """
+        Get the last snapshot received from the collector process
+
+        Returns:
+            Current metrics snapshot
+        """
+        with self.metrics_lock:
+            return self.current_snapshot
+
+    def wait_first_collection(self, timeout: Optional[float] = None) -> Optional[bool]:
+        """
+        Wait for the first collection to finish
+
+        Args:
+            timeout: Maximum time to wait in seconds
+
+        Returns:
+            True if nvidia-smi answered the first collection, False if it failed,
+            None if the first collection did not finish in time
+        """
+        if not self.first_collection.wait(timeout):
+            return None
+        return self.nvidia_available
+
+    def _spawn(self) -> Optional[str]:
+        """
+        Start a collector process and wait until its sinks are set up
+
+        Returns:
+            Error message if the process failed to start, None otherwise
+        """
+        self.connection, child_connection = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(
+            target=_collector_process,
+            args=(child_connection, self.options, self.sinks, self.log_file,
+                  self.current_snapshot.seq, self.epoch, self.spawned),
+            daemon=True,
+            name="CMPurplePillCollector"
+        )
+        self.process.start()
+        self.spawned += 1
+        # Only the child holds its end, so the pipe reports EOF when it exits
+        child_connection.close()
+
+        try:
+            if not self.connection.poll(START_TIMEOUT):
+                return f"no response within {START_TIMEOUT}s"
+            kind, payload = self.connection.recv()
+        except (EOFError, OSError):
+            return f"exited with code {self.process.exitcode}"
+
+        if kind != "started":
+            return payload
+        return None
+
+    def _terminate(self) -> None:
+        """Stop the current collector process, killing it if it does not exit in time"""
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(STOP_TIMEOUT)
+            if self.process.is_alive():
+                self.logger.warning(f"Collector process {self.process.pid} did not stop, killing it")
+                self.process.kill()
+                self.process.join(STOP_TIMEOUT)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _supervise_loop(self) -> None:
+        """Receive snapshots from the collector process and restart it when it fails"""
+        backoff = RESTART_BACKOFF_MIN
+
+        while self.running:
+            started = time.monotonic()
+            reason = self._receive_loop()
+            if not self.running:
+                return
+
+            self._terminate()
+            if time.monotonic() - started >= STABLE_RUNTIME:
+                backoff = RESTART_BACKOFF_MIN
+
+            self.logger.warning(f"Collector process {reason}, restarting in {backoff}s")
+            if self.stopped.wait(backoff):
+                return
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+
+            self.restarts += 1
+            error = self._spawn()
+            if error:
+                self.logger.error(f"Failed to start the collector process: {error}")
+                continue
+            self.logger.info(f"Collector process {self.process.pid} started, restart {self.restarts}")
+
+    def _receive_loop(self) -> str:
+        """
+        Handle the messages of the collector process until it fails
+
+        Returns:
+            Reason the collector process is restarted
+        """
+        while self.running:
+            try:
+                if self.connection.poll(1):
+                    self._handle(*self.connection.recv())
+            except (EOFError, OSError):
+                self.process.join(STOP_TIMEOUT)
+                return f"exited with code {self.process.exitcode}"
+
+            if self.memory_limit:
+                rss = get_rss_mib(self.process.pid)
+                if rss is not None and rss > self.memory_limit:
+                    return f"uses {rss:.0f} MiB, above the limit of {self.memory_limit} MiB"
+
+        return "stopped"
+
+    def _handle(self, kind: str, payload: Any) -> None:
+        """Handle a message of the collector process"""
+        if kind == "snapshot":
+            with self.metrics_lock:
+                # A restarted collector serves its warm start only until it collected
+                if payload.stale and self.current_snapshot.seq:
+                    return
+                self.current_snapshot = payload
+            if payload.stale:
+                return
+
+            for listener in self.listeners:
+                try:
+                    listener(payload)
+                except Exception as e:
+                    self.logger.error(f"Error in snapshot listener: {e}")
+
+        elif kind == "ready":
+            if not self.first_collection.is_set():
+                self.nvidia_available = payload
+                self.first_collection.set()
+
+        elif kind == "error":
+            self.logger.error(f"Collector process failed: {payload}")
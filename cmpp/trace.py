@@ -0,0 +1,379 @@
+"""
+Source access, recording and replay for CM PurplePill
+
+The collector reads its sources (nvidia-smi, NVML, /proc and the clock)
+through a SourceIO object. RecordingIO additionally writes the result of
+every call to a trace, and ReplayIO serves the results of a trace back,
+so collector performance and exposition output can be examined offline.
+
+A trace is a gzip compressed JSON lines file. The first line is a header:
+
+    {"version": 2, "cmpp": "0.0.3", "hostname": "gpu-node-1", "nvml": true,
+     "tiers": {"inventory": 300, "processes": 15, "gpu": 15}}
+
+Every following line holds one collection cycle, with the tiers it
+collected and the calls in the order they completed. Process environments
+are recorded with the values of variables other than RECORDED_ENV_VARS
+masked:
+
+    {"tiers": ["processes", "gpu"], "time": 1742610441.2, "calls": [["run", [["nvidia-smi", ...]], [true, "..."]], ...]}
+
+A collector process restarted by the supervisor continues the trace in a
+part of its own, e.g. cmpp-trace.1.jsonl.gz after cmpp-trace.jsonl.gz, as
+the previous part may end without a gzip trailer if its process was
+killed. Replaying the trace reads all of its parts in order.
+
+Copyright 2025 ConfidentialMind Oy
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cmpp import __version__, nvml
+from cmpp.pod_info import read_proc_file
+from cmpp.utils import execute_command
+
+
+TRACE_VERSION = 2
+
+# Environment variables read by pod_info.get_pod_info; the values of all
+# other variables are masked in traces, as they may hold secrets
+RECORDED_ENV_VARS = frozenset((
+    "HOSTNAME", "KUBERNETES_NAMESPACE", "POD_NAMESPACE", "KUBERNETES_SERVICE_HOST",
+    "SERVICE_NAME", "APP_NAME", "STACK_ID",
+))
+
+
+def part_path(path: str, part: int) -> str:
+    """
+    Get the path of a part of a trace
+
+    Args:
+        path: Path of the trace, which is its first part
+        part: Number of the part, 0 for the first
+
+    Returns:
+        Path with the part number inserted before the extensions of the file name
+    """
+    if not part:
+        return path
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.{part}{dot}{extensions}")
+
+
+def trace_parts(path: str) -> List[str]:
+    """
+    Find the parts of a trace that follow its first part
+
+    Args:
+        path: Path of the trace, which is its first part
+
+    Returns:
+        Paths of the existing parts after the first, in part order
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    prefix = os.path.join(directory, f"{stem}.")
+    suffix = f"{dot}{extensions}"
+
+    parts = []
+    for candidate in glob.glob(f"{glob.escape(prefix)}*{glob.escape(suffix)}"):
+        number = candidate[len(prefix):len(candidate) - len(suffix)]
+        if number.isdigit() and int(number) > 0:
+            parts.append((int(number), candidate))
+    return [candidate for _, candidate in sorted(parts)]
+
+
+class SourceIO:
+    """Live access to the data sources of the collector"""
+
+    def run(self, command: List[str]) -> Tuple[bool, str]:
+        """Execute a command, see utils.execute_command"""
+        return execute_command(command)
+
+    def read_proc(self, path: str) -> Optional[bytes]:
+        """Read a /proc file, None if it cannot be read"""
+        return read_proc_file(path)
+
+    def nvml_available(self) -> bool:
+        """Check whether NVML can be used, see nvml.nvml_available"""
+        return nvml.nvml_available()
+
+    def gpu_counters(self, uuids: List[str]) -> Dict[str, Tuple[Optional[int], ...]]:
+        """Read the NVML counters of GPUs, see nvml.get_gpu_counters"""
+        return nvml.get_gpu_counters(uuids)
+
+    def process_utilization(self, uuid: str, since: int) -> Tuple[Dict[int, float], int]:
+        """Read the per-process utilization of a GPU, see nvml.get_process_utilization"""
+        return nvml.get_process_utilization(uuid, since)
+
+    def time(self) -> float:
+        """Get the wall clock time"""
+        return time.time()
+
+    def watch_gpus(self, uuids: List[str]) -> Any:
+        """Create an event set waking on GPU activity, see nvml.create_event_set"""
+        return nvml.create_event_set(uuids)
+
+    def wait_gpu_event(self, event_set: Any, timeout: float) -> bool:
+        """Wait for GPU activity, see nvml.wait_event"""
+        return nvml.wait_event(event_set, timeout)
+
+    def begin_cycle(self, tiers: List[str]) -> None:
+        """Called before a collection cycle runs the named tiers"""
+
+    def end_cycle(self) -> None:
+        """Called after a collection cycle"""
+
+    def close(self) -> None:
+        """Release the resources of the source access"""
+
+
+def _mask_environ(data: bytes) -> bytes:
+    """Mask the values of environment variables not used for pod attribution, keeping their length"""
+    masked = []
+    for var in data.split(b"\0"):
+        key, sep, value = var.partition(b"=")
+        if sep and key.decode("utf-8", errors="ignore") not in RECORDED_ENV_VARS:
+            value = b"*" * len(value)
+        masked.append(key + sep + value)
+    return b"\0".join(masked)
+
+
+def _encode_bytes(data: Optional[bytes]) -> Optional[str]:
+    """Represent file content in JSON, byte for byte"""
+    return data.decode("latin-1") if data is not None else None
+
+
+def _decode_bytes(data: Optional[str]) -> Optional[bytes]:
+    """Restore file content encoded by _encode_bytes"""
+    return data.encode("latin-1") if data is not None else None
+
+
+class RecordingIO(SourceIO):
+    """Live source access that writes every result to a trace file"""
+
+    def __init__(self, path: str, hostname: str, tiers: Dict[str, float], part: int = 0):
+        """
+        Create the trace file and write its header
+
+        The first part replaces the parts of an earlier trace at the same path.
+
+        Args:
+            path: Path of the trace file
+            hostname: Hostname used in the metric labels
+            tiers: Interval of each collection tier
+            part: Number of the part to write, see part_path
+        """
+        self.logger = logging.getLogger("cmpp")
+        self.path = part_path(path, part)
+        self.lock = threading.Lock()
+        self.file = gzip.open(self.path, "wt", encoding="utf-8")
+        if not part:
+            for stale in trace_parts(path):
+                os.remove(stale)
+        self.cycle = None
+        self.cycles = 0
+
+        self._write({"version": TRACE_VERSION, "cmpp": __version__, "hostname": hostname,
+                     "nvml": super().nvml_available(), "tiers": tiers})
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        """Write a line and flush it, so the trace is readable while recording"""
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def _record(self, method: str, args: List[Any], result: Any) -> Any:
+        """Add a call to the current cycle and return its result"""
+        if self.cycle is not None:
+            self.cycle["calls"].append([method, args, result])
+        return result
+
+    def run(self, command):
+        return self._record("run", [command], super().run(command))
+
+    def read_proc(self, path):
+        data = super().read_proc(path)
+        if data is not None and path.endswith("/environ"):
+            self._record("read_proc", [path], _encode_bytes(_mask_environ(data)))
+        else:
+            self._record("read_proc", [path], _encode_bytes(data))
+        return data
+
+    def gpu_counters(self, uuids):
+        return self._record("gpu_counters", [uuids], super().gpu_counters(uuids))
+
+    def process_utilization(self, uuid, since):
+        return self._record("process_utilization", [uuid, since], super().process_utilization(uuid, since))
+
+    def time(self):
+        return self._record("time", [], super().time())
+
+    def begin_cycle(self, tiers):
+        self.cycle = {"tiers": tiers, "time": time.time(), "calls": []}
+
+    def end_cycle(self):
+        if self.cycle is not None:
+            self._write(self.cycle)
+            self.cycle = None
+            self.cycles += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.logger.info(f"Recorded {self.cycles} collection cycles to {self.path}")
+
+
+class ReplayIO(SourceIO):
+    """
+    Source access serving the results of a trace
+
+    Within a cycle, calls are matched by method and arguments, in recorded
+    order. A call that was not recorded, e.g. made by a newer collector,
+    gets the result of a failed source. The parts written by restarted
+    collector processes are replayed after the first one.
+    """
+
+    def __init__(self, path: str):
+        """
+        Read the header of a trace file
+
+        Args:
+            path: Path of the trace file
+
+        Raises:
+            ValueError: If the file is not a trace of a supported version
+        """
+        self.path = path
+        self.parts = [path] + trace_parts(path)
+        self.header = self._open(path)
+
+        # Sources are fetched concurrently
+        self.lock = threading.Lock()
+        self.calls: Dict[str, List[Any]] = {}
+        self.now = 0.0
+        self.missed = 0
+
+    def _open(self, path: str) -> Dict[str, Any]:
+        """
+        Open a part of the trace and read its header
+
+        Args:
+            path: Path of the part
+
+        Returns:
+            Header of the part
+
+        Raises:
+            ValueError: If the file is not a trace of a supported version
+        """
+        self.file = gzip.open(path, "rt", encoding="utf-8")
+        try:
+            header = json.loads(self.file.readline())
+        except (OSError, EOFError, ValueError) as e:
+            self.file.close()
+            raise ValueError(f"{path} is not a CM PurplePill trace: {e}")
+
+        if not isinstance(header, dict) or header.get("version") != TRACE_VERSION:
+            self.file.close()
+            raise ValueError(f"{path} is not a CM PurplePill trace of version {TRACE_VERSION}")
+        return header
+
+    def cycles(self) -> Iterator[List[str]]:
+        """
+        Load the cycles of all parts of the trace one by one
+
+        Yields:
+            Names of the tiers to run for the loaded cycle
+        """
+        for index, path in enumerate(self.parts):
+            if index:
+                self.file.close()
+                try:
+                    self._open(path)
+                except (OSError, ValueError) as e:
+                    logging.getLogger("cmpp").warning(f"Skipping trace part: {e}")
+                    continue
+            yield from self._part_cycles()
+
+    def _part_cycles(self) -> Iterator[List[str]]:
+        """Load the cycles of the open part one by one"""
+        while True:
+            try:
+                line = self.file.readline()
+                cycle = json.loads(line) if line else None
+            except (EOFError, ValueError):
+                # Part of a collector that did not shut down cleanly
+                return
+            if cycle is None:
+                return
+
+            with self.lock:
+                self.now = cycle["time"]
+                self.calls = {}
+                for method, args, result in cycle["calls"]:
+                    self.calls.setdefault(json.dumps([method, args]), []).append(result)
+            yield cycle["tiers"]
+
+    def _replay(self, method: str, args: List[Any], default: Any, required: bool = True) -> Any:
+        """Get the next recorded result of a call"""
+        with self.lock:
+            results = self.calls.get(json.dumps([method, args]))
+            if not results:
+                if required:
+                    self.missed += 1
+                    logging.getLogger("cmpp").debug(f"Not in trace: {method}{tuple(args)}")
+                return default
+            return results.pop(0)
+
+    def run(self, command):
+        success, output = self._replay("run", [command], [False, "Command not recorded"])
+        return success, output
+
+    def read_proc(self, path):
+        return _decode_bytes(self._replay("read_proc", [path], None))
+
+    def nvml_available(self):
+        return self.header["nvml"]
+
+    def gpu_counters(self, uuids):
+        counters = self._replay("gpu_counters", [uuids], {})
+        return {uuid: tuple(values) for uuid, values in counters.items()}
+
+    def process_utilization(self, uuid, since):
+        utilization, newest = self._replay("process_utilization", [uuid, since], [{}, since])
+        return {int(pid): value for pid, value in utilization.items()}, newest
+
+    def time(self):
+        return self._replay("time", [], self.now, required=False)
+
+    def watch_gpus(self, uuids):
+        # Replay runs cycles back to back, there is nothing to wait for
+        return None
+
+    def close(self):
+        self.file.close()
@@ -18,6 +18,7 @@ limitations under the License.
 
 import logging
 import os
+import re
 import subprocess
 import sys
 from typing import Dict, List, Optional, Tuple, Union
@@ -115,6 +116,54 @@ def is_numeric(value: str) -> bool:
         return False
 
 
+_LABEL_RE = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_labels(labels: str) -> Dict[str, str]:
+    """
+    Parse a Prometheus labels string
+    
+    Args:
+        labels: Labels string without braces, e.g. 'pod="a",namespace="b"'
+        
+    Returns:
+        Dictionary of label names and values
+    """
+    return dict(_LABEL_RE.findall(labels))
+
+
+def to_number(value: str) -> Union[int, float, None]:
+    """
+    Convert a numeric string from nvidia-smi to a number
+    
+    Args:
+        value: String to convert
+        
+    Returns:
+        int for integral values, float otherwise, None if not numeric
+    """
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def format_number(value: float) -> str:
+    """
+    Format a number for the Prometheus exposition without losing precision
+    
+    Args:
+        value: Number to format
+        
+    Returns:
+        Integral values without a fraction, others rounded to 3 decimals
+    """
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(round(value, 3))
+
+
 def write_atomic(file_path: str, content: str) -> bool:
     """
     Write content to a file atomically using a temporary file
@@ -147,14 +196,3 @@ def write_atomic(file_path: str, content: str) -> bool:
             pass
             
         return False
-
-
-def check_nvidia_tools() -> bool:
-    """
-    Check if NVIDIA tools are available
-    
-    Returns:
-        True if nvidia-smi is available, False otherwise
-    """
-    success, _ = execute_command(["nvidia-smi", "--version"])
-    return success
@@ -50,6 +50,9 @@ setup(
     package_data=package_data,
     include_package_data=True,
     entry_points=entry_points,
+    extras_require={
+        "nvml": ["nvidia-ml-py"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",  # Update with your actual license